@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark of how the time to build a Lineage object scales with the number of taxids.
+A synthetic taxonomy tree (a complete tree with four children per node, about as deep as the NCBI tree)
+is written to a temporary nodes.dmp file, and Lineage objects are built for 1k up to 1M of its taxids.
+The time per taxid should stay about the same for all sizes.
+The node names are looked up in the names index of the package, so the NCBI data has to be downloaded.
+
+Usage: python3 lineage_scaling.py [size ...]
+
+Copyright (C) 2017-2021  Martin Engqvist Lab
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from orgtools import org_tax
+
+
+RANKS = ['no rank', 'superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+
+def make_taxonomy(num_nodes, filepath):
+	'''
+	Write a nodes.dmp file with a complete tree where node t has node t // 4 as parent (node 1 is the root).
+	'''
+	with open(filepath, 'w') as f:
+		f.write('1\t|\t1\t|\tno rank\t|\t\t|\n')
+		for taxid in range(2, num_nodes + 1):
+			depth = len(bin(taxid)) // 2
+			f.write('%s\t|\t%s\t|\t%s\t|\t\t|\n' % (taxid, max(taxid // 4, 1), RANKS[min(depth, len(RANKS) - 1)]))
+
+
+def main(sizes):
+	num_nodes = int(max(sizes) * 1.5)
+	with tempfile.TemporaryDirectory() as folder:
+		filepath = os.path.join(folder, 'nodes.dmp')
+		print('Making a synthetic taxonomy with %s nodes ...' % num_nodes)
+		make_taxonomy(num_nodes, filepath)
+		taxonomy = org_tax.Taxonomy(filepath)
+
+	rng = random.Random(42)
+	results = []
+	for size in sizes:
+		taxid_list = [str(s) for s in rng.sample(range(2, num_nodes + 1), size)]
+
+		start_time = time.perf_counter()
+		lineage_object = org_tax.Lineage('taxid', taxid_list, taxonomy=taxonomy)
+		elapsed = time.perf_counter() - start_time
+
+		assert len(lineage_object.lineages()) == size
+		results.append((size, elapsed))
+
+	print()
+	print('taxids\tseconds\tmicroseconds per taxid')
+	for size, elapsed in results:
+		print('%s\t%.2f\t%.1f' % (size, elapsed, elapsed / size * 1e6))
+
+	# with linear scaling the time per taxid is about the same at the smallest and the largest size
+	first_size, first_elapsed = results[0]
+	last_size, last_elapsed = results[-1]
+	print()
+	print('%sx more taxids took %.1fx longer' % (last_size // first_size, last_elapsed / first_elapsed))
+
+
+if __name__ == '__main__':
+	sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+	main(sorted(sizes))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+A compact probabilistic set (Bloom filter) used to skip lookups that are certain to fail.
+A negative answer is always correct, a positive answer is wrong with a small, chosen probability.
+
+Copyright (C) 2017-2021  Martin Engqvist Lab
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import math
+import os
+import struct
+
+
+class BloomFilter(object):
+	'''
+	A Bloom filter for strings, sized for an expected number of items and a false positive rate.
+	The bit positions are derived from a single blake2b digest by double hashing.
+	'''
+	def __init__(self, capacity, error_rate=0.001):
+		assert capacity >= 0, 'Error, the capacity cannot be negative'
+		assert 0 < error_rate < 1, 'Error, the error rate must be between 0 and 1'
+
+		capacity = max(capacity, 1)
+		self.num_bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+		self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+		self.bits = bytearray((self.num_bits + 7) // 8)
+
+
+	def _positions(self, item):
+		'''
+		The bit positions for an item.
+		'''
+		digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+		h1, h2 = struct.unpack('<QQ', digest)
+		return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+
+	def add(self, item):
+		'''
+		Add an item to the filter.
+		'''
+		bits = self.bits
+		for pos in self._positions(item):
+			bits[pos >> 3] |= 1 << (pos & 7)
+
+
+	def update(self, items):
+		'''
+		Add many items to the filter.
+		'''
+		for item in items:
+			self.add(item)
+
+
+	def __contains__(self, item):
+		bits = self.bits
+		return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+	def save(self, filepath):
+		'''
+		Write the filter to a file.
+		The file is written to a temporary file first so that an interrupted write is never used.
+		'''
+		temp_filepath = filepath + '.tmp'
+		with open(temp_filepath, 'wb') as f:
+			f.write(struct.pack('<QQ', self.num_bits, self.num_hashes))
+			f.write(self.bits)
+		os.replace(temp_filepath, filepath)
+
+
+	@classmethod
+	def load(cls, filepath):
+		'''
+		Read a filter that was written with save().
+		'''
+		with open(filepath, 'rb') as f:
+			num_bits, num_hashes = struct.unpack('<QQ', f.read(16))
+			bits = bytearray(f.read())
+
+		assert len(bits) == (num_bits + 7) // 8, 'Error, the filter in "%s" is truncated' % filepath
+
+		bloom = cls.__new__(cls)
+		bloom.num_bits = num_bits
+		bloom.num_hashes = num_hashes
+		bloom.bits = bits
+		return bloom
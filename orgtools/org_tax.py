@@ -16,16 +16,24 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import heapq
 import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import ItemsView, Mapping, ValuesView
 from orgtools import helpfunctions
 from pkg_resources import resource_stream, resource_filename, resource_exists
 import os
-from os.path import isfile, exists
+import sqlite3
+from os.path import isfile, exists, getmtime
 
 # Set up variables to keep track of the NCBI files
 NAMES_FILE = 'data/ncbi_data/names.dmp'
 NODES_FILE = 'data/ncbi_data/nodes.dmp'
 ZIPFILE = 'data/ncbi_data/taxdmp.zip'
+NAMES_INDEX = 'data/ncbi_data/names.db'
 
 
 
@@ -60,27 +68,83 @@ if not resource_exists(__name__, NAMES_FILE) or not resource_exists(__name__, NO
 	_download_file()
 
 
+def _build_name_index():
+	'''
+	Build an SQLite index of the names.dmp file.
+	One table maps every name to its taxid, another maps each taxid to its scientific name.
+	The index is written to a temporary file first so that an interrupted build is never used.
+	'''
+	print('Indexing the NCBI names file. This only has to be done once...')
+	filepath = resource_filename(__name__, NAMES_INDEX)
+	temp_filepath = filepath + '.tmp'
+	if exists(temp_filepath):
+		os.remove(temp_filepath)
+
+	con = sqlite3.connect(temp_filepath)
+	con.execute('CREATE TABLE names (name TEXT, taxid INTEGER)')
+	con.execute('CREATE TABLE scientific (taxid INTEGER PRIMARY KEY, name TEXT)')
+
+	def _name_rows(f):
+		for line in f:
+			taxid, org, unique_name, category, *rest = line.decode('utf-8').split('\t|\t')
+			yield org.strip(), int(taxid)
+
+	def _scientific_rows(f):
+		for line in f:
+			taxid, org, unique_name, category, *rest = line.decode('utf-8').split('\t|\t')
+			if category.rstrip('\t|\n') == 'scientific name':
+				yield int(taxid), org
+
+	# the name table keeps the file order, lookups rely on it to let the last match win
+	with resource_stream(__name__, NAMES_FILE) as f:
+		con.executemany('INSERT INTO names VALUES (?, ?)', _name_rows(f))
+	with resource_stream(__name__, NAMES_FILE) as f:
+		con.executemany('INSERT OR REPLACE INTO scientific VALUES (?, ?)', _scientific_rows(f))
+	con.execute('CREATE INDEX names_name ON names (name)')
+	con.commit()
+	con.close()
+
+	os.replace(temp_filepath, filepath)
+	print('Done')
+
+
+def _check_name_index():
+	'''
+	See whether the names index is there and up to date with names.dmp, build it if not.
+	'''
+	assert resource_exists(__name__, NAMES_FILE), 'Error, could not find "names.dmp" in the filepath %s' % resource_filename(__name__, NAMES_FILE)
+
+	index_filepath = resource_filename(__name__, NAMES_INDEX)
+	if not isfile(index_filepath) or getmtime(index_filepath) < getmtime(resource_filename(__name__, NAMES_FILE)):
+		_build_name_index()
+
+	return index_filepath
+
+
+def _chunks(values, size=500):
+	'''
+	Split a list into chunks that fit in a single parameterized SQLite query.
+	'''
+	for n in range(0, len(values), size):
+		yield values[n:n+size]
+
+
 def get_taxid(organism_list):
 	'''
 	Given a list of organisms, looks up the taxonomic identifier for these.
 	Relies on the NCBI taxonomy resource.
 	Returns a dictionary with organism keys and taxid values.
 	'''
-	assert resource_exists(__name__, NAMES_FILE), 'Error, could not find "names.dmp" in the filepath %s' % resource_filename(__name__, NAMES_FILE)
-
 	organism_set = set(helpfunctions._normalize_org_names(organism_list))
 	out_data = {key:'None' for key in organism_set}
 
-	# Go through the file line by line and search for matches
-	with resource_stream(__name__, NAMES_FILE) as f:
-		for line in f:
-			taxid, org, *rest = line.decode('utf-8').split('|') #get data from the line
-			taxid = taxid.strip()
-			org = org.strip()
-
-			# is it present in my list?
-			if org in organism_set:
-				out_data[org] = taxid
+	# Look up the names in the index, in file order so that the last match wins
+	con = sqlite3.connect(_check_name_index())
+	for chunk in _chunks(list(organism_set)):
+		query = 'SELECT name, taxid FROM names WHERE name IN (%s) ORDER BY rowid' % ','.join('?' * len(chunk))
+		for org, taxid in con.execute(query, chunk):
+			out_data[org] = str(taxid)
+	con.close()
 
 	return out_data
 
@@ -88,24 +152,21 @@ def get_taxid(organism_list):
 def get_organism(taxid_list):
 	'''
 	Given a list of taxonomic identifiers, looks up the organism name for these.
-	Making use of a list ensures that the file only has to be scanned once.
 	Relies on the NCBI taxonomy resource.
 	Returns a dictionary with taxid values and organism values.
 	'''
-	assert resource_exists(__name__, NAMES_FILE), 'Error, could not find "names.dmp" in the filepath %s' % resource_filename(__name__, NAMES_FILE)
-
-
 	taxid_set = set([str(x) for x in taxid_list])
 	out_data = {key:'None' for key in taxid_set}
 
-	# Go through the file line by line and search for matches
-	with resource_stream(__name__, NAMES_FILE) as f:
-		for line in f:
-			taxid, trash, org, trash2, trash3, trash4, category, *rest = line.decode('utf-8').split('\t') #get data from the line
+	# only identifiers that are numbers can be present in the index
+	numeric = [int(s) for s in taxid_set if s.isdigit()]
 
-			# is it present in my list?
-			if taxid in taxid_set and category == 'scientific name':
-				out_data[taxid] = org
+	con = sqlite3.connect(_check_name_index())
+	for chunk in _chunks(numeric):
+		query = 'SELECT taxid, name FROM scientific WHERE taxid IN (%s)' % ','.join('?' * len(chunk))
+		for taxid, org in con.execute(query, chunk):
+			out_data[str(taxid)] = org
+	con.close()
 
 	return out_data
 
@@ -116,211 +177,460 @@ def get_organism(taxid_list):
 ############################### Lineage stuff below here ########################################
 
 
+class Taxonomy(object):
+	'''
+	An in-memory representation of the NCBI taxonomy tree.
+	The nodes.dmp file is parsed once into compact integer arrays (parent taxid, rank code and depth)
+	that are indexed by taxid. Lineages are then resolved by following parent pointers in memory.
+	'''
+	def __init__(self, filepath=None):
+		if filepath is None:
+			assert resource_exists(__name__, NODES_FILE), 'Error, could not find "nodes.dmp" in the filepath %s' % resource_filename(__name__, NODES_FILE)
+			filepath = resource_filename(__name__, NODES_FILE)
+
+		# rank code 0 is reserved for taxids that are not present in the file
+		self.rank_names = [None]
+		self.rank_codes = {}
+
+		# parse the file into flat arrays first, the size of the taxid index is not known until the end
+		taxids = array('i')
+		parents = array('i')
+		ranks = array('B')
+		with open(filepath, 'rb') as f:
+			for line in f:
+				node_id, parent_node_id, rank, *junk = line.split(b'\t|\t', 3)
+
+				rank = rank.decode('utf-8')
+				code = self.rank_codes.get(rank)
+				if code is None:
+					code = len(self.rank_names)
+					self.rank_codes[rank] = code
+					self.rank_names.append(rank)
+
+				taxids.append(int(node_id))
+				parents.append(int(parent_node_id))
+				ranks.append(code)
+
+		# now place everything at the index of the taxid
+		size = max(taxids) + 1 if taxids else 2
+		self.parents = array('i', bytes(4 * size))
+		self.ranks = array('B', bytes(size))
+		for taxid, parent, code in zip(taxids, parents, ranks):
+			self.parents[taxid] = parent
+			self.ranks[taxid] = code
+
+		self.depths = self._get_depths(taxids)
+
+		# per-rank ancestor tables, these are made when they are first needed
+		self.ancestor_tables = {}
+
+
+	def _get_depths(self, taxids):
+		'''
+		Compute the number of nodes between each taxid and the root.
+		Every node is visited only once, paths are filled in on the way back down.
+		'''
+		depths = array('H', bytes(2 * len(self.parents)))
+		known = bytearray(len(self.parents))
+		known[1] = 1
+
+		for taxid in taxids:
+			path = []
+			node = taxid
+			while not known[node]:
+				path.append(node)
+				node = self.parents[node]
+
+				# guard against parents that are missing from the file
+				if self.ranks[node] == 0:
+					known[node] = 1
+					break
+
+			depth = depths[node]
+			for node in reversed(path):
+				depth += 1
+				depths[node] = depth
+				known[node] = 1
+
+		return depths
+
+
+	def __contains__(self, taxid):
+		try:
+			taxid = int(taxid)
+		except (TypeError, ValueError):
+			return False
+		return 0 < taxid < len(self.ranks) and self.ranks[taxid] != 0
+
+
+	def parent(self, taxid):
+		'''
+		Get the parent taxid of a taxid.
+		'''
+		return self.parents[int(taxid)]
+
+
+	def rank(self, taxid):
+		'''
+		Get the rank of a taxid as a string.
+		'''
+		return self.rank_names[self.ranks[int(taxid)]]
+
+
+	def depth(self, taxid):
+		'''
+		Get the number of nodes between a taxid and the root.
+		'''
+		return self.depths[int(taxid)]
+
+
+	def lineage(self, taxid):
+		'''
+		Get the lineage of a taxid as a list of integer taxids, starting at the root.
+		Returns None if the taxid is not present in the taxonomy.
+		'''
+		if taxid not in self:
+			return None
+
+		taxid = int(taxid)
+		parents = self.parents
+		nodes = [taxid]
+		while taxid != 1 and parents[taxid] != 0:
+			taxid = parents[taxid]
+			nodes.append(taxid)
+
+		return nodes[::-1]
+
+
+	def ancestor_table(self, rank):
+		'''
+		Get a NumPy array, indexed by taxid, holding the ancestor of each taxid at a rank
+		(the taxid itself if it has that rank, 0 if it has no ancestor with that rank).
+		The table is filled one depth level at a time, from the root down, so that every parent is done before its children.
+		'''
+		import numpy as np
+
+		table = self.ancestor_tables.get(rank)
+		if table is not None:
+			return table
+
+		parents = np.frombuffer(self.parents, dtype=np.int32)
+		ranks = np.frombuffer(self.ranks, dtype=np.uint8)
+		depths = np.frombuffer(self.depths, dtype=np.uint16)
+
+		table = np.zeros(len(parents), dtype=np.int32)
+		code = self.rank_codes.get(rank)
+		if code is not None:
+			present = np.flatnonzero(ranks != 0)
+			order = present[np.argsort(depths[present], kind='stable')]
+			bounds = np.searchsorted(depths[order], np.arange(int(depths.max()) + 2))
+			for depth in range(len(bounds) - 1):
+				nodes = order[bounds[depth]:bounds[depth+1]]
+				table[nodes] = np.where(ranks[nodes] == code, nodes, table[parents[nodes]])
+
+		self.ancestor_tables[rank] = table
+		return table
+
+
+_TAXONOMY = None
+
+def get_taxonomy():
+	'''
+	Get the taxonomy tree. The nodes.dmp file is only parsed the first time this is called.
+	'''
+	global _TAXONOMY
+	if _TAXONOMY is None:
+		print('loading taxonomy tree')
+		_TAXONOMY = Taxonomy()
+	return _TAXONOMY
+
+
+
+# the lineage of an organism that no taxid was found for
+_NO_INPUT_RANKS = ('root', 'no rank', 'superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+
+
+class _LineageDict(dict):
+	'''
+	A read-only dictionary with taxid or organism keys and lineage values, for the lineages of a Lineage object.
+	Only the taxid of each lineage is stored, the lineage dictionary (with the keys 'nodes', 'ranks' and 'names')
+	is made from the taxonomy tree and the name table of the Lineage object when it is asked for.
+	'''
+	__slots__ = ('owner',)
+
+	def __init__(self, owner):
+		super().__init__()
+		self.owner = owner
+
+
+	def __getitem__(self, key):
+		return self.owner._make_lineage(dict.__getitem__(self, key))
+
+
+	def get(self, key, default=None):
+		taxid = dict.get(self, key)
+		if taxid is None:
+			return default
+		return self.owner._make_lineage(taxid)
+
+
+	# iterating over the keys explicitly makes dict() and ** go through __getitem__ instead of copying the taxids
+	def __iter__(self):
+		return iter(self.keys())
+
+
+	def items(self):
+		return ItemsView(self)
+
+
+	def values(self):
+		return ValuesView(self)
+
+
+	def copy(self):
+		return dict(self)
+
+
+	def __eq__(self, other):
+		if not isinstance(other, Mapping):
+			return NotImplemented
+		return dict(self) == dict(other)
+
+
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		return equal if equal is NotImplemented else not equal
+
+
+	def __repr__(self):
+		return repr(dict(self))
+
+
+	def _read_only(self, *args, **kwargs):
+		raise TypeError('The lineages are read-only, use dict() to get a copy that can be changed')
+
+	__setitem__ = __delitem__ = __ior__ = update = pop = popitem = setdefault = clear = _read_only
+
+
+	def _store(self, data):
+		'''
+		Add the taxids of lineages, used by the Lineage object.
+		'''
+		dict.update(self, data)
+
+
+	# pickling and copying would otherwise put the items back one by one through the blocked __setitem__.
+	# The taxids are handed to the constructor and the owner is set afterwards, as the owner refers back to this object
+	def __reduce__(self):
+		return (_restore_lineage_dict, (dict(dict.items(self)),), self.owner)
+
+
+	def __setstate__(self, owner):
+		self.owner = owner
+
+
+def _restore_lineage_dict(data):
+	'''
+	Make a _LineageDict with the stored taxids of a pickled or copied one, its owner is set by __setstate__.
+	'''
+	lineage_dict = _LineageDict(None)
+	lineage_dict._store(data)
+	return lineage_dict
+
+
+
 class Lineage(object):
 	'''
 	A class for getting taxonomic lineages.
+	By default all lineages are resolved when the object is made.
+	With lazy=True a lineage is only resolved the first time it is asked for, and then kept,
+	resolve() can still be used to resolve many of them at once.
 	'''
-	def __init__(self, input_type, input_list):
+	def __init__(self, input_type, input_list, taxonomy=None, lazy=False):
 		assert input_type in ['organism', 'taxid'], 'Error, "input_type" must be "organism" or "taxid"'
 
-		assert resource_exists(__name__, NODES_FILE), 'Error, could not find "nodes.dmp" in the filepath %s' % resource_filename(__name__, NODES_FILE)
+		# the parsed taxonomy tree is shared between all Lineage objects unless one is supplied
+		if taxonomy is None:
+			taxonomy = get_taxonomy()
+		self.taxonomy = taxonomy
 
 		self.input_type = input_type
-		self.input_list = input_list
+		self.input_list = list(input_list)
 		self.input_set = set(self.input_list)
+		self.lazy = lazy
 
-		# Make sure I have both the organism names and the taxids
-		if self.input_type == 'organism':
-			self.organism_set = self.input_set
-			self.org_taxid_translation = get_taxid(self.organism_set)
+		# in lazy mode, the input organism names for each normalized name, so that lineage() can find them by either
+		self.normalized_input = {}
+		self._normalize_input(self.input_list)
 
-			self.taxid_org_translation = {v: k for k, v in self.org_taxid_translation.items()}
-			self.taxid_set = self.taxid_org_translation.keys()
+		# the translations and lineages, these are filled in as the identifiers are resolved
+		self.resolved = set()
+		self.org_taxid_translation = {}
+		self.taxid_org_translation = {}
+		self.taxid_lineage_data = _LineageDict(self)
+		self.organism_lineage_data = _LineageDict(self)
 
-		else:
-			self.taxid_set = self.input_set
-			self.taxid_org_translation = get_organism(self.taxid_set)
-			self.org_taxid_translation = {v: k for k, v in self.taxid_org_translation.items()}
-			self.organism_set = self.org_taxid_translation.keys()
+		# only the taxid of each lineage is stored, the nodes are followed through the taxonomy tree
+		# and the names of the nodes are kept once in a shared table
+		self.node_names = {}
 
-		self.memoization_dict = {} # for caching lineage information to reduce computational burden
-
-		# get the lineages, both with taxid and organism keys
-		print('getting lineages')
-		self.taxid_lineage_data = self._get_all_lineages()
-		print('done')
-		self.organism_lineage_data = self._convert_lineage_identifier()
+		if not self.lazy:
+			self.resolve()
 
 
-	def _find_beginning_of_line(self, bit, filehandle):
+	def _normalize_input(self, identifiers):
 		'''
-		Finds the start of a line in the middle of a file.
+		Record the normalized names of input organisms, which is only needed in lazy mode.
 		'''
-		# start in the middle
-		filehandle.seek(bit, 0)
+		if self.lazy and self.input_type == 'organism':
+			for identifier in identifiers:
+				self.normalized_input.setdefault(helpfunctions._normalize_name(identifier), set()).add(identifier)
 
-		# move back up to find start of line
-		line_len = 0
-		lastline = ''
-		temporary_bit = bit
-		while True:
-			line = filehandle.readline()
 
-			if len(line) > line_len:
-				lastline = line
-				line_len = len(line)
-				temporary_bit -= 1
-				filehandle.seek(temporary_bit, 0)
-			else:
-				line = lastline
-				break
-
-		return line, temporary_bit+1
-
-
-	def _get_parent_node(self, start_bit, end_bit, taxid, filehandle, lastnode = ''):
+	def resolve(self, identifiers=None):
 		'''
-		Find parent taxonomy node for another taxonomy node or taxid
-		Leverages divide and conquor to make the search fast.
+		Resolve the lineages of a collection of input identifiers (by default all of them) in bulk.
+		Identifiers that have already been resolved are skipped.
 		'''
-		# for this function I need taxid to be an integer
-		taxid = int(taxid)
+		if identifiers is None:
+			identifiers = self.input_set
+		pending = set(identifiers) - self.resolved
+		if not pending:
+			return
+
+		# Make sure I have both the organism names and the taxids
+		if self.input_type == 'organism':
+			org_taxid_translation = get_taxid(pending)
+			taxid_org_translation = {v: k for k, v in org_taxid_translation.items()}
 
-		# get midpoint bit
-		midpoint_bit = start_bit + (end_bit - start_bit) // 2
-
-		# get the document line that contains this bit position
-		line, midpoint_bit = self._find_beginning_of_line(midpoint_bit, filehandle)
-
-		# parse the line
-		node_id, parent_node_id, rank, *junk = line.split(b'|')
-		node_id = int(node_id.strip())
-
-		# Guard against taxids that are not present, can cause the script to get stuck.
-		# Compare with the node found last iteration and if they are the same, abort.
-		if lastnode == node_id:
-			if taxid != node_id:
-				if taxid < node_id: # sometimes the answer is a few lines up, backtrack to find it
-					return self._get_parent_node(start_bit-200, end_bit, taxid, filehandle, lastnode)
-
-				elif taxid > node_id:
-					# At the end of the iteration the answer is sometimes a few down, check for this
-					filehandle.seek(midpoint_bit, 0)
-					line = filehandle.readline()
-
-					for i in range(4):
-						if line == b'': # seems I bump into the end of the file sometimes, workaround for that...
-							filehandle.seek(midpoint_bit-400, 0) # completely random the seek bits used here, may be a better setting
-							line = filehandle.readline()
-						node_id, parent_node_id, rank, *junk = line.split(b'|')
-						node_id = int(node_id.strip())
-						if taxid == node_id:
-							break
-						line = filehandle.readline()
-
-			if not taxid == node_id:
-				print('No lineage found for "%s"' % taxid)
-				return None, None
 		else:
-			lastnode = node_id
+			# taxids that have been seen as nodes of earlier lineages already have a name
+			taxid_org_translation = {s:self.node_names[s] for s in pending if s in self.node_names}
+			unknown = [s for s in pending if s not in self.node_names]
+			if unknown:
+				taxid_org_translation.update(get_organism(unknown))
+			org_taxid_translation = {v: k for k, v in taxid_org_translation.items()}
 
+		self.org_taxid_translation.update(org_taxid_translation)
+		self.taxid_org_translation.update(taxid_org_translation)
 
-		# use devide and conquor to find the taxid
-		if taxid == node_id: # check whether the id was found
-			return int(parent_node_id.strip()), rank.decode('utf-8').strip()
+		# get the lineages, both with taxid and organism keys
+		if not self.lazy:
+			print('getting lineages')
+		taxid_lineage_data = self._get_all_lineages(taxid_org_translation.keys())
+		if not self.lazy:
+			print('done')
+		self.taxid_lineage_data._store(taxid_lineage_data)
+		self.organism_lineage_data._store(org_taxid_translation)
 
-		elif taxid > node_id:
-			start_bit = midpoint_bit
+		self.resolved.update(pending)
 
-		elif taxid < node_id:
-			end_bit = midpoint_bit
 
-		return self._get_parent_node(start_bit, end_bit, taxid, filehandle, lastnode)
+	def add(self, identifier):
+		'''
+		Add a single organism name or taxid (of the same input type as the others), see extend().
+		'''
+		self.extend([identifier])
 
 
-	def _get_single_taxid_lineage(self, taxid):
+	def extend(self, identifiers):
 		'''
-		Build up the entire lineage for a single taxid.
-		Return a list of taxid parent nodes as well as a list of parent ranks.
+		Add organism names or taxids (of the same input type as the others) to the object.
+		Only the new identifiers are resolved, the names of nodes that are already known are reused.
+		The lineages() and identifiers() methods include the new identifiers afterwards.
 		'''
-		with open(resource_filename(__name__, NODES_FILE), 'rb') as f:
-			# get starting bit of the file (for subsequnet divide and conquor)
-			f.seek(0)
-			start_bit = f.tell()
+		new = [s for s in dict.fromkeys(identifiers) if s not in self.input_set]
+		self.input_list.extend(new)
+		self.input_set.update(new)
+		self._normalize_input(new)
 
-			# get end bit of the file (for subsequnet divide and conquor)
-			f.seek(0, 2)
-			end_bit = f.tell()
+		if not self.lazy:
+			self.resolve(new)
 
-			# Now find the entire parent lineage
-			parent_nodes = [taxid]
-			parent_ranks = []
-			taxid = int(taxid)
-			while taxid not in [1, None]:
 
-				# check whether I have this information aldready cached, of not get from flatfile
-				parent_data = self.memoization_dict.get(taxid)
-				if parent_data is None:
-					parent_data = self._get_parent_node(start_bit, end_bit, taxid, f)
-					self.memoization_dict[taxid] = parent_data # update memoization dictionary with new data
+	def _make_lineage(self, taxid):
+		'''
+		Build up the entire lineage dictionary for a single taxid from the taxonomy tree and the name table.
+		'''
+		if taxid == 'None': # no taxid was found for the organism
+			return {'nodes':['None'] * len(_NO_INPUT_RANKS), 'ranks':list(_NO_INPUT_RANKS), 'names':['None'] * len(_NO_INPUT_RANKS)}
 
-				taxid, rank = parent_data
-				parent_nodes.append(str(taxid))
-				parent_ranks.append(rank)
+		nodes = self.taxonomy.lineage(taxid)
+		if nodes is None:
+			nodes = ['None', taxid]
+			ranks = ['root', None]
+		else:
+			rank_names = self.taxonomy.rank_names
+			rank_codes = self.taxonomy.ranks
+			ranks = ['root'] + [rank_names[rank_codes[s]] for s in nodes[1:]]
+			nodes = [str(s) for s in nodes[:-1]] + [taxid]
 
-			parent_ranks.append('root')
-			return parent_nodes[::-1], parent_ranks[::-1]
+		names = self.node_names
+		return {'nodes':nodes, 'ranks':ranks, 'names':[names[s] for s in nodes]}
 
 
-	def _get_all_lineages(self):
+	def _get_all_lineages(self, taxid_set):
 		'''
 		Given a list of taxonomic identifiers, looks up the full taxonomic lineage for all of these.
 		Relies on the NCBI taxonomy resource.
-		Returns a dictionary with taxid or organism keys and lineage values.
+		Only the names of the nodes are stored, returns a dictionary with taxid keys and values
+		(the lineages themselves are followed through the taxonomy tree when they are asked for).
 		'''
-		# I want to keep track of all nodes for fast lookup of names
-		all_taxid_nodes = set([])
+		node_names = self.node_names
+		parents = self.taxonomy.parents
+
+		# I want to keep track of all nodes without a name for a single lookup of the names at the end
+		unknown = set()
 
 		out_data = {}
-		for taxid in self.taxid_set:
+		for taxid in taxid_set:
 			taxid = str(taxid)
+			out_data[taxid] = taxid
 
 			if taxid == 'None': # The input was none, this can happen when no taxid is found for an supposed organism
-				out_data[taxid] = {'nodes': ['None', 'None', 'None', 'None', 'None', 'None', 'None', 'None', 'None'],
-									 'ranks': ['root', 'no rank', 'superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species'],
-									 'names': ['None', 'None', 'None', 'None', 'None', 'None', 'None', 'None', 'None']}
-
-				# update node set
-				all_taxid_nodes = all_taxid_nodes | set(['None'])
-
-			else:
-				# get the nodes and ranks and save to data structure
-				parent_nodes, parent_ranks = self._get_single_taxid_lineage(taxid)
-				out_data[taxid] = {'nodes':parent_nodes, 'ranks':parent_ranks}
-
-				# update node set
-				all_taxid_nodes = all_taxid_nodes | set(parent_nodes)
+				continue
 
-		# now get the names for all intermediate nodes
-		names = get_organism(all_taxid_nodes)
+			if taxid not in self.taxonomy:
+				print('No lineage found for "%s"' % taxid)
+				unknown.update(s for s in ('None', taxid) if s not in node_names)
+				continue
 
-		# add to data structure
-		for taxid in out_data.keys():
-			out_data[taxid]['names'] = [names[s] for s in out_data[taxid]['nodes']]
+			# collect the nodes that need a name, from the leaf up. Once a node is known its parents are as well,
+			# so each node is only visited once over all lineages
+			node = taxid
+			number = int(taxid)
+			while node not in node_names and node not in unknown:
+				unknown.add(node)
+				if number == 1 or parents[number] == 0:
+					break
+				number = parents[number]
+				node = str(number)
+
+		# now get the names for all intermediate nodes, only looking up the ones that are not known from before
+		if unknown:
+			node_names.update(get_organism(unknown))
 
 		return out_data
 
 
-	def _convert_lineage_identifier(self):
+	def _lineage_taxid(self, identifier):
 		'''
-		Convert the linage dictionary that has taxid keys such that it has organism keys.
+		Get the taxid that the lineage of a taxid or organism is stored under, or None if it is not part of the input.
+		In lazy mode the lineage is resolved on first use, organism names are matched after normalization.
 		'''
-		out_data = {}
-		for taxid in self.taxid_lineage_data.keys():
-			organism = self.taxid_org_translation[taxid]
-			out_data[organism] = self.taxid_lineage_data[taxid]
+		if self.input_type == 'organism':
+			identifier = helpfunctions._normalize_name(identifier)
+			pending = self.normalized_input.get(identifier, set()) - self.resolved
+			if pending:
+				self.resolve(pending)
 
-		return out_data
+			return dict.get(self.organism_lineage_data, identifier)
+
+		else:
+			if identifier in self.input_set and identifier not in self.resolved:
+				self.resolve([identifier])
+
+			return dict.get(self.taxid_lineage_data, identifier)
 
 
 	def lineage(self, identifier):
@@ -329,31 +639,36 @@ class Lineage(object):
 		The dictionary has the three keys 'nodes', 'ranks', 'names'.
 		Those each hold ordered lists of node taxonomic identifiers, the taxonomic ranks for each node and the names of each node.
 		'''
-		if self.input_type == 'organism':
-			identifier = helpfunctions._normalize_name(identifier)
-			lineage = self.organism_lineage_data.get(identifier)
-			if lineage is None:
-				return None
-
-		else:
-			lineage = self.taxid_lineage_data.get(identifier)
-			if lineage is None:
-				return None
+		taxid = self._lineage_taxid(identifier)
+		if taxid is None:
+			return None
 
-		return lineage
+		return self._make_lineage(taxid)
 
 
 	def domain(self, identifier):
 		'''
 		Get the domain of life for a given identifier.
 		'''
-		lineage = self.lineage(identifier)
+		taxid = self._lineage_taxid(identifier)
 
-		if lineage is None:
+		if taxid is None:
 			return 'Unknown'
 
-		for i in range(0, len(lineage['ranks'])):
-			if lineage['ranks'][i] == 'superkingdom':
+		# look for the superkingdom in the taxonomy tree directly, rather than building the whole lineage dictionary
+		nodes = None if taxid == 'None' else self.taxonomy.lineage(taxid)
+		if nodes is not None:
+			code = self.taxonomy.rank_codes.get('superkingdom')
+			rank_codes = self.taxonomy.ranks
+			for node in nodes[1:]:
+				if rank_codes[node] == code:
+					return self.node_names[str(node)]
+			return self.node_names[taxid]
+
+		lineage = self._make_lineage(taxid)
+		ranks = lineage['ranks']
+		for i in range(0, len(ranks)):
+			if ranks[i] == 'superkingdom':
 				break
 
 		return lineage['names'][i]
@@ -364,7 +679,10 @@ class Lineage(object):
 		Retreives lineages for all taxids or organisms.
 		Returns a dictionary with taxid or organism keys wich each holds a dictionary with the three keys 'nodes', 'ranks', 'names'.
 		Those each hold ordered lists of node taxonomic identifiers, the taxonomic ranks for each node and the names of each node.
+		In lazy mode all lineages that have not been resolved yet are resolved first.
 		'''
+		self.resolve()
+
 		if self.input_type == 'organism':
 			return self.organism_lineage_data
 
@@ -379,16 +697,398 @@ class Lineage(object):
 		return self.input_set
 
 
+######################### Project taxids onto ranks #########################
+
+
+# the ranks that rank_columns() returns by default
+RANK_COLUMNS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus']
+
+
+def _taxid_array(taxid_list, taxonomy):
+	'''
+	Convert taxids (integers or strings) to an integer NumPy array.
+	Taxids that are not valid or not present in the taxonomy become 0.
+	'''
+	import numpy as np
+
+	taxids = np.asarray(taxid_list)
+	if taxids.dtype.kind not in 'iu':
+		taxids = np.array([int(s) if str(s).isdigit() else 0 for s in taxid_list], dtype=np.int64)
+	taxids = taxids.astype(np.int64)
+
+	ranks = np.frombuffer(taxonomy.ranks, dtype=np.uint8)
+	valid = (taxids > 0) & (taxids < len(ranks))
+	taxids[~valid] = 0
+	taxids[ranks[taxids] == 0] = 0
+	return taxids
+
+
+def rank_columns(taxid_list, ranks=None, names=True, taxonomy=None, as_frame=False):
+	'''
+	Get the ancestor of each taxid at each of a list of ranks (by default superkingdom down to genus), in one go.
+	Returns a dictionary with a NumPy array of ancestor taxids for each rank (0 if the taxid has no ancestor at that rank),
+	and, if names is True, an array with the names of these ancestors under the key "<rank>_name" (None if there is no ancestor).
+	With as_frame=True a pandas DataFrame with the same columns is returned instead.
+	Requires NumPy (and pandas for as_frame).
+	'''
+	import numpy as np
+
+	if ranks is None:
+		ranks = RANK_COLUMNS
+	if taxonomy is None:
+		taxonomy = get_taxonomy()
+
+	taxids = _taxid_array(taxid_list, taxonomy)
+	ancestors = {rank:taxonomy.ancestor_table(rank)[taxids] for rank in ranks}
+
+	# look up the names of all ancestors at once, and spread them out again
+	if names and len(taxids):
+		unique = np.unique(np.concatenate(list(ancestors.values())))
+		unique = unique[unique != 0]
+		name_data = get_organism([str(s) for s in unique])
+		name_array = np.array([None] + [name_data[str(s)] for s in unique], dtype=object)
+
+	columns = {}
+	for rank in ranks:
+		columns[rank] = ancestors[rank]
+		if names:
+			if len(taxids):
+				positions = np.searchsorted(unique, ancestors[rank]) + 1
+				positions[ancestors[rank] == 0] = 0
+				columns['%s_name' % rank] = name_array[positions]
+			else:
+				columns['%s_name' % rank] = np.array([], dtype=object)
+
+	if as_frame:
+		import pandas as pd
+		return pd.DataFrame(columns)
+
+	return columns
+
+
 
 
 
 ######################### Calculate taxonomic distance #########################
 
 
+class LCAIndex(object):
+	'''
+	A lowest common ancestor index over the part of the taxonomy tree that is spanned by a set of lineages.
+	The tree is flattened into an Euler tour, and a sparse table over the node depths along the tour
+	answers the lowest common ancestor of any two nodes with two table lookups.
+	A virtual node (index 0) sits above the root, lineages that could not be resolved are placed there.
+	'''
+	def __init__(self, lineages):
+		# node index 0 is the virtual top node
+		self.nodes = [None]
+		self.ranks = [None]
+		self.names = [None]
+		self.parents = array('i', [-1])
+		self.depths = array('i', [0])
+		self.node_index = {}
+		children = [[]]
+
+		# merge the lineages into a tree, remembering the leaf node of each one
+		self.leaves = array('i')
+		for lineage in lineages:
+			parent = 0
+			if lineage is not None and lineage['nodes'][0] != 'None':
+				for node, rank, name in zip(lineage['nodes'], lineage['ranks'], lineage['names']):
+					i = self.node_index.get(node)
+					if i is None:
+						i = len(self.nodes)
+						self.node_index[node] = i
+						self.nodes.append(node)
+						self.ranks.append(rank)
+						self.names.append(name)
+						self.parents.append(parent)
+						self.depths.append(self.depths[parent] + 1)
+						children.append([])
+						children[parent].append(i)
+					parent = i
+			self.leaves.append(parent)
+
+		self.children = children
+		self._euler_tour(children)
+		self._sparse_table()
+
+
+	def _euler_tour(self, children):
+		'''
+		Walk the tree depth first and record every node each time it is visited.
+		The first and last visit of each node are kept for range lookups.
+		'''
+		self.euler = array('i')
+		self.first = array('i', [0]) * len(self.nodes)
+		self.last = array('i', [0]) * len(self.nodes)
+
+		stack = [(0, 0)]
+		while stack:
+			node, child_number = stack.pop()
+			if child_number == 0:
+				self.first[node] = len(self.euler)
+			self.euler.append(node)
+			self.last[node] = len(self.euler) - 1
+
+			if child_number < len(children[node]):
+				stack.append((node, child_number + 1))
+				stack.append((children[node][child_number], 0))
+
+
+	def _sparse_table(self):
+		'''
+		Level k of the table holds the shallowest node in each window of 2**k positions of the Euler tour.
+		'''
+		depths = self.depths
+		self.table = [self.euler]
+		width = 1
+		while 2 * width <= len(self.euler):
+			previous = self.table[-1]
+			level = array('i', [0]) * (len(self.euler) - 2 * width + 1)
+			for i in range(len(level)):
+				a = previous[i]
+				b = previous[i + width]
+				level[i] = a if depths[a] <= depths[b] else b
+			self.table.append(level)
+			width *= 2
+
+
+	def lca(self, node1, node2):
+		'''
+		Get the index of the lowest common ancestor of two node indices.
+		'''
+		left = self.first[node1]
+		right = self.first[node2]
+		if left > right:
+			left, right = right, left
+
+		k = (right - left + 1).bit_length() - 1
+		a = self.table[k][left]
+		b = self.table[k][right - (1 << k) + 1]
+		return a if self.depths[a] <= self.depths[b] else b
+
+
+def _row_batches(n, batch_size):
+	'''
+	Split the rows of the upper triangle of an n by n matrix into consecutive batches of at most batch_size pairs.
+	A row that is larger than batch_size gets a batch of its own.
+	'''
+	start = 0
+	while start < n - 1:
+		stop = start + 1
+		pairs = n - 1 - start
+		while stop < n - 1 and pairs + n - 1 - stop <= batch_size:
+			pairs += n - 1 - stop
+			stop += 1
+		yield start, stop
+		start = stop
+
+
+def _condensed_pairs(n, start, stop):
+	'''
+	Get the row and column indices of all the pairs in rows start to stop of a condensed n by n matrix,
+	in the order in which they are stored.
+	'''
+	import numpy as np
+
+	rows = np.arange(start, stop, dtype=np.int64)
+	counts = n - 1 - rows
+	offsets = np.cumsum(counts) - counts
+	row_index = np.repeat(rows, counts)
+	col_index = np.arange(counts.sum(), dtype=np.int64) - np.repeat(offsets, counts) + row_index + 1
+
+	return row_index, col_index
+
+
+def _vector_scores(arrays, score_type, rows, cols):
+	'''
+	Compute the distance scores for the identifier pairs given by two index arrays.
+	The lowest common ancestors are looked up in the sparse table for all pairs at once.
+	'''
+	import numpy as np
+
+	left = arrays['first'][rows]
+	right = arrays['first'][cols]
+	left, right = np.minimum(left, right), np.maximum(left, right)
+
+	# the largest power of two that fits in each query window
+	k = np.frexp((right - left + 1).astype(np.float64))[1] - 1
+	a = arrays['table'][k, left]
+	b = arrays['table'][k, right - (1 << k) + 1]
+	depths = arrays['depths']
+	nodes = np.where(depths[a] <= depths[b], a, b)
+
+	if score_type == 'rank':
+		return arrays['node_scores'][nodes]
+
+	elif score_type == 'length':
+		return (arrays['leaf_depths'][rows] + arrays['leaf_depths'][cols] - 2 * depths[nodes]) / 2
+
+	else:
+		raise ValueError
+
+
+def _write_progress(filepath, rows):
+	'''
+	Record the number of finished rows of a distance matrix on disk.
+	A temporary file is used so that the progress file is never left half written.
+	'''
+	with open(filepath + '.progress.tmp', 'w') as f:
+		f.write(str(rows))
+	os.replace(filepath + '.progress.tmp', filepath + '.progress')
+
+
+def load_distance(filepath):
+	'''
+	Open a distance matrix written by Distance.memmap_distance() without reading it into memory.
+	Returns the memory-mapped matrix and a list of the identifiers for its rows and columns.
+	'''
+	import numpy as np
+
+	with open(filepath + '.progress', 'r') as f:
+		done = int(f.read())
+	with open(filepath + '.identifiers', 'r') as f:
+		identifiers = f.read().split('\n')
+	assert done == len(identifiers), 'Error, the distance matrix in %s is not finished, only %s of %s rows are done' % (filepath, done, len(identifiers))
+
+	return np.load(filepath, mmap_mode='r'), identifiers
+
+
+def _fill_condensed(out_data, arrays, score_type, n, start, stop):
+	'''
+	Score all pairs in rows start to stop of a condensed n by n matrix and write them to their place in out_data.
+	'''
+	rows, cols = _condensed_pairs(n, start, stop)
+	offset = n * start - start * (start + 1) // 2
+	out_data[offset:offset + len(rows)] = _vector_scores(arrays, score_type, rows, cols)
+
+
+def _fill_tile_rows(matrix, arrays, score_type, start, stop, tile_size):
+	'''
+	Score rows start to stop of a square distance matrix, one tile at a time.
+	Each tile in the upper triangle is written together with its mirror image.
+	'''
+	import numpy as np
+
+	n = matrix.shape[0]
+	for col_start in range(start, n, tile_size):
+		col_stop = min(col_start + tile_size, n)
+		rows = np.repeat(np.arange(start, stop), col_stop - col_start)
+		cols = np.tile(np.arange(col_start, col_stop), stop - start)
+		tile = _vector_scores(arrays, score_type, rows, cols).reshape(stop - start, col_stop - col_start)
+		matrix[start:stop, col_start:col_stop] = tile
+		matrix[col_start:col_stop, start:stop] = tile.T
+
+	# an organism has no distance to itself
+	matrix[range(start, stop), range(start, stop)] = 0
+
+
+def _share_arrays(arrays):
+	'''
+	Copy a dictionary of NumPy arrays into shared memory.
+	Returns the shared memory blocks, which have to be closed and unlinked when done,
+	and a description of the arrays that worker processes can attach to.
+	'''
+	import numpy as np
+
+	blocks = []
+	specs = {}
+	for name, data in arrays.items():
+		block = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+		np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[...] = data
+		blocks.append(block)
+		specs[name] = (block.name, data.shape, data.dtype.str)
+
+	return blocks, specs
+
+
+def _release_arrays(blocks):
+	'''
+	Close and remove shared memory blocks made by _share_arrays().
+	'''
+	for block in blocks:
+		block.close()
+		block.unlink()
+
+
+def _attach_arrays(specs):
+	'''
+	Attach to arrays that were placed in shared memory by _share_arrays().
+	Returns the shared memory blocks, which have to be kept open while the arrays are used, and the arrays.
+	'''
+	import numpy as np
+
+	blocks = []
+	arrays = {}
+	for name, (block_name, shape, dtype) in specs.items():
+		block = shared_memory.SharedMemory(name=block_name)
+		blocks.append(block)
+		arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+	return blocks, arrays
+
+
+_WORKER_SHARED = None
+
+def _init_shared_worker(specs, score_type, n):
+	'''
+	Attach each worker process to the shared index once.
+	'''
+	global _WORKER_SHARED
+	blocks, arrays = _attach_arrays(specs)
+	_WORKER_SHARED = (blocks, arrays, score_type, n)
+
+
+def _condensed_worker(batch):
+	'''
+	Score a batch of rows of a condensed distance matrix into the shared output in a worker process.
+	'''
+	blocks, arrays, score_type, n = _WORKER_SHARED
+	start, stop = batch
+	_fill_condensed(arrays['out'], arrays, score_type, n, start, stop)
+	return stop
+
+
+def _memmap_worker(args):
+	'''
+	Score a row of tiles of a distance matrix on disk in a worker process.
+	'''
+	import numpy as np
+
+	blocks, arrays, score_type, n = _WORKER_SHARED
+	filepath, start, stop, tile_size = args
+	matrix = np.load(filepath, mmap_mode='r+')
+	_fill_tile_rows(matrix, arrays, score_type, start, stop, tile_size)
+	matrix.flush()
+	del matrix
+	return stop
+
+
+_WORKER_DISTANCE = None
+
+def _init_worker(distance_object):
+	'''
+	Keep the index of a Distance object in each worker process, so that it is only sent once per worker.
+	'''
+	global _WORKER_DISTANCE
+	_WORKER_DISTANCE = distance_object
+
+
+def _nearest_worker(args):
+	'''
+	Find the nearest relatives for a chunk of identifiers in a worker process.
+	'''
+	identifiers, k = args
+	return {identifier:_WORKER_DISTANCE._nearest(identifier, k) for identifier in identifiers}
+
+
 class Distance(object):
 	'''
 	A class for calculating phylogenetic distances between organisms or taxonomic identifiers.
 	'''
+	# A rigid scoring system based solely on the deepest common rank
+	SCORES = {'root':7, 'superkingdom':6, 'phylum':5, 'class':4, 'order':3, 'family':2, 'genus':1, 'species':0}
 
 	def __init__(self, linage_object, score_type='rank'):
 		'''
@@ -402,46 +1102,56 @@ class Distance(object):
 		self.lin_data = linage_object
 		self.score_type = score_type
 
+		# a lazy Lineage object resolves all lineages in bulk rather than one at a time below
+		self.lin_data.resolve()
+
+		# index the tree spanned by the input so that common nodes can be looked up in constant time,
+		# the identifiers are sorted so that they come in the same order every time (which memmap_distance() relies on when resuming)
+		self.identifier_list = sorted(self.lin_data.identifiers())
+		self.index = LCAIndex(self.lin_data.lineage(s) for s in self.identifier_list)
+		self.leaf = dict(zip(self.identifier_list, self.index.leaves))
+		self.position = {identifier:n for n, identifier in enumerate(self.identifier_list)}
+		self.node_scores = self._get_node_scores()
 
-	def _find_common_taxid(self, lineage1, lineage2):
+
+	def _get_node_scores(self):
 		'''
-		Helper function to find the closest taxonomic node of two organisms.
+		For every node in the index get the score of the deepest scored rank at or above it.
+		Nodes without one of the scored ranks (such as "no rank") inherit the score of their parent.
 		'''
-		node = None
-		rank = None
-		name = None
+		scores = array('B', [self.SCORES['root']]) * len(self.index.nodes)
+		for i in range(1, len(self.index.nodes)):
+			score = self.SCORES.get(self.index.ranks[i])
+			scores[i] = scores[self.index.parents[i]] if score is None else score
 
-		# Go through each node in the first lineage and see whether it is in the other lineage
-		out_data = {}
-		for i in range(0, len(lineage1['nodes'])):
+		return scores
 
-			# All lineages starts with the root, so go through and see at which level the node is no longer common
-			if lineage1['nodes'][i] in lineage2['nodes']:
-				node = lineage1['nodes'][i]
-				rank = lineage1['ranks'][i]
-				name = lineage1['names'][i]
-			else:
-				break
 
-		out_data['node'] = node
-		out_data['rank'] = rank
-		out_data['name'] = name
-
-		return out_data
+	def _find_common_node(self, identifier1, identifier2):
+		'''
+		Helper function to find the index of the closest common taxonomic node of two organisms.
+		'''
+		return self.index.lca(self.leaf[identifier1], self.leaf[identifier2])
 
 
-	def _distance_score(self, rank, lineage1, lineage2):
+	def _node_data(self, node):
 		'''
-		Return a distance score for two lineages where the common node has been determined.
+		Get the taxid, rank and name of a node in the index.
 		'''
+		return {'node':self.index.nodes[node], 'rank':self.index.ranks[node], 'name':self.index.names[node]}
+
 
-		if self.score_type == 'rank': # A rigid scoring system based solely on the common rank
-			SCORES = {'root':7, 'superkingdom':6, 'phylum':5, 'class':4, 'order':3, 'family':2, 'genus':1, 'species':0}
-			score = SCORES[rank]
+	def _distance_score(self, node, identifier1, identifier2):
+		'''
+		Return a distance score for two organisms where the common node has been determined.
+		'''
+		if self.score_type == 'rank':
+			score = self.node_scores[node]
 
 		elif self.score_type == 'length': # A flexible scoring system based on the actual number of nodes between two leaves
-			lin1_len = len(lineage1['rank']) - lineage1['rank'].index(rank) - 1
-			lin2_len = len(lineage2['rank']) - lineage2['rank'].index(rank) - 1
+			depths = self.index.depths
+			lin1_len = depths[self.leaf[identifier1]] - depths[node]
+			lin2_len = depths[self.leaf[identifier2]] - depths[node]
 			score = (lin1_len + lin2_len)/2
 
 		else:
@@ -450,22 +1160,429 @@ class Distance(object):
 		return score
 
 
+	def _pair_score(self, identifier1, identifier2):
+		'''
+		Get the distance score for a pair of organisms.
+		'''
+		node = self._find_common_node(identifier1, identifier2)
+		return self._distance_score(node, identifier1, identifier2)
+
+
 	def _combine_all(self):
 		'''
 		Helper function to generate all combinations of organisms.
 		'''
-		input_combos = itertools.combinations(self.lin_data.identifiers(), 2)
+		input_combos = itertools.combinations(self.identifier_list, 2)
 
 		return input_combos
 
 
-	def _combine_target_with_all(self, target):
+	def _tree_summary(self):
 		'''
-		Helper function to make all pairs of organisms (or taxid) containing a target organism (or taxid).
+		Summarize where the identifiers sit in the index.
+		The identifiers are sorted by the Euler tour position of their leaf, which makes the identifiers
+		below any node a consecutive slice of that order. For each node the shallowest and deepest leaf
+		below it is also recorded.
 		'''
-		input_combos = ((target, single_input) for single_input in self.lin_data.identifiers() if single_input != target)
+		if getattr(self, '_summary', None) is None:
+			index = self.index
+			order = sorted(range(len(self.identifier_list)), key=lambda i: index.first[index.leaves[i]])
+			firsts = [index.first[index.leaves[i]] for i in order]
 
-		return input_combos
+			min_depths = array('i', [len(index.nodes)]) * len(index.nodes)
+			max_depths = array('i', [-1]) * len(index.nodes)
+			for leaf in index.leaves:
+				min_depths[leaf] = index.depths[leaf]
+				max_depths[leaf] = index.depths[leaf]
+
+			# parents always have a lower index than their children
+			for node in range(len(index.nodes) - 1, 0, -1):
+				parent = index.parents[node]
+				min_depths[parent] = min(min_depths[parent], min_depths[node])
+				max_depths[parent] = max(max_depths[parent], max_depths[node])
+
+			self._summary = (order, firsts, min_depths, max_depths)
+
+		return self._summary
+
+
+	def _branches(self, node, exclude_child=None, exclude_identifier=None):
+		'''
+		Split the identifiers below a node into groups such that any two identifiers from different groups
+		have the node as their closest common node. Each identifier placed at the node itself forms its own group,
+		and the identifiers below each child node form one group.
+		Returns a list of (start, stop, min_depth, max_depth) tuples, where start and stop give the slice of the summary order.
+		'''
+		order, firsts, min_depths, max_depths = self._tree_summary()
+		index = self.index
+		depth = index.depths[node]
+
+		branches = []
+		start = bisect_left(firsts, index.first[node])
+		stop = bisect_right(firsts, index.first[node])
+		for i in range(start, stop):
+			if order[i] != exclude_identifier:
+				branches.append((i, i + 1, depth, depth))
+
+		for child in index.children[node]:
+			if child == exclude_child or max_depths[child] == -1:
+				continue
+			start = bisect_left(firsts, index.first[child])
+			stop = bisect_right(firsts, index.last[child])
+			branches.append((start, stop, min_depths[child], max_depths[child]))
+
+		return branches
+
+
+	def _sorted_pairs(self, pairs):
+		'''
+		Turn pairs of identifier indices into identifier pairs, in the same order as itertools.combinations gives them.
+		'''
+		pairs = sorted((a, b) if a < b else (b, a) for a, b in pairs)
+		return [(self.identifier_list[a], self.identifier_list[b]) for a, b in pairs]
+
+
+	def _extreme_pairs(self, smallest):
+		'''
+		Find the identifier pairs with the smallest (or largest) distance score without scoring every pair.
+		Every node where at least two groups of identifiers meet is the closest common node for the pairs across those groups.
+		The best score that each such node can give is computed from its groups, and pairs are only listed for the best nodes.
+		'''
+		order, firsts, min_depths, max_depths = self._tree_summary()
+		depths = self.index.depths
+		pick = min if smallest else max
+
+		# find the best score that each node can give, scores of 'length' are kept doubled to stay integers
+		candidates = []
+		for node in range(len(self.index.nodes)):
+			branches = self._branches(node)
+			if len(branches) < 2:
+				continue
+
+			if self.score_type == 'rank':
+				score = self.node_scores[node]
+			elif smallest:
+				first, second = sorted(s[2] for s in branches)[:2]
+				score = first + second - 2 * depths[node]
+			else:
+				first, second = sorted(s[3] for s in branches)[-2:]
+				score = first + second - 2 * depths[node]
+			candidates.append((score, node, branches))
+
+		if not candidates:
+			return None, []
+
+		best_score = pick(s[0] for s in candidates)
+
+		# now list the pairs across the groups at the best nodes
+		pairs = []
+		for score, node, branches in candidates:
+			if score != best_score:
+				continue
+
+			seen = {}
+			for start, stop, junk, junk2 in branches:
+				members = order[start:stop]
+				if self.score_type == 'rank':
+					earlier = [b for s in seen.values() for b in s]
+				for a in members:
+					if self.score_type == 'rank':
+						wanted = earlier
+					else:
+						wanted = seen.get(best_score + 2 * depths[node] - depths[self.index.leaves[a]], [])
+					pairs.extend((a, b) for b in wanted)
+				for a in members:
+					seen.setdefault(depths[self.index.leaves[a]], []).append(a)
+
+		if self.score_type == 'length':
+			best_score = best_score / 2
+
+		return best_score, self._sorted_pairs(pairs)
+
+
+	def _extreme_relatives(self, identifier, smallest):
+		'''
+		Find the identifiers with the smallest (or largest) distance score to a target identifier without scoring every pair.
+		Only the nodes on the path from the target to the root can be closest common nodes, at each of them
+		the candidates are the identifiers that are not below the previous node on the path.
+		'''
+		assert identifier in self.leaf, 'Error, the identifier %s is not part of your input.' % identifier
+
+		order, firsts, min_depths, max_depths = self._tree_summary()
+		depths = self.index.depths
+		target = self.position[identifier]
+		target_depth = depths[self.leaf[identifier]]
+		pick = min if smallest else max
+
+		# walk up the path, scores of 'length' are kept doubled to stay integers
+		candidates = []
+		previous = None
+		node = self.leaf[identifier]
+		while node != -1:
+			branches = self._branches(node, exclude_child=previous, exclude_identifier=target)
+			if branches:
+				if self.score_type == 'rank':
+					score = self.node_scores[node]
+				else:
+					depth = pick(s[2] if smallest else s[3] for s in branches)
+					score = target_depth + depth - 2 * depths[node]
+				candidates.append((score, node, branches))
+
+			previous = node
+			node = self.index.parents[node]
+
+		if not candidates:
+			return None, []
+
+		best_score = pick(s[0] for s in candidates)
+
+		pairs = []
+		for score, node, branches in candidates:
+			if score != best_score:
+				continue
+			for start, stop, junk, junk2 in branches:
+				for b in order[start:stop]:
+					if self.score_type == 'rank' or target_depth + depths[self.index.leaves[b]] - 2 * depths[node] == best_score:
+						pairs.append(b)
+
+		if self.score_type == 'length':
+			best_score = best_score / 2
+
+		return best_score, [(identifier, self.identifier_list[b]) for b in sorted(pairs)]
+
+
+	def _nearest(self, identifier, k):
+		'''
+		Find the k identifiers with the smallest distance score to a target identifier.
+		The path from the target to the root is walked upwards and stopped as soon as no node further up can give a better score.
+		Ties are resolved in favour of the identifiers that are found first.
+		Scores of 'length' are kept doubled to stay integers.
+		'''
+		order, firsts, min_depths, max_depths = self._tree_summary()
+		depths = self.index.depths
+		leaves = self.index.leaves
+		target = self.position[identifier]
+		target_depth = depths[self.leaf[identifier]]
+
+		# the heap holds the k best so far with the worst (and most recently found) on top
+		heap = []
+		counter = 0
+		previous = None
+		node = self.leaf[identifier]
+		while node != -1:
+			for start, stop, min_depth, junk in self._branches(node, exclude_child=previous, exclude_identifier=target):
+				if self.score_type == 'rank':
+					lowest = self.node_scores[node]
+				else:
+					lowest = target_depth + min_depth - 2 * depths[node]
+				if len(heap) >= k and lowest >= -heap[0][0]:
+					continue
+
+				for b in order[start:stop]:
+					if self.score_type == 'rank':
+						score = lowest
+					else:
+						score = target_depth + depths[leaves[b]] - 2 * depths[node]
+
+					counter += 1
+					if len(heap) < k:
+						heapq.heappush(heap, (-score, -counter, b))
+					elif score < -heap[0][0]:
+						heapq.heappushpop(heap, (-score, -counter, b))
+					elif self.score_type == 'rank':
+						break
+
+			previous = node
+			node = self.index.parents[node]
+
+			# stop when the next node up cannot give a better score
+			if node != -1 and len(heap) >= k:
+				if self.score_type == 'rank':
+					bound = self.node_scores[node]
+				else:
+					bound = target_depth - depths[node]
+				if bound >= -heap[0][0]:
+					break
+
+		out_data = []
+		for score, counter, b in sorted(heap, key=lambda s: (-s[0], -s[1])):
+			score = -score if self.score_type == 'rank' else -score / 2
+			out_data.append((self.identifier_list[b], score))
+
+		return out_data
+
+
+	def _nearest_data(self):
+		'''
+		Get a copy of the object with only the parts of the index that _nearest() uses, for the worker processes.
+		The Lineage object and the names and ranks of the nodes are left out, so that little has to be sent
+		when the workers are started with spawn or forkserver (with fork they inherit it without copying).
+		'''
+		index = LCAIndex.__new__(LCAIndex)
+		for name in ('parents', 'depths', 'leaves', 'children', 'first', 'last'):
+			setattr(index, name, getattr(self.index, name))
+
+		distance = Distance.__new__(Distance)
+		for name in ('score_type', 'identifier_list', 'leaf', 'position', 'node_scores'):
+			setattr(distance, name, getattr(self, name))
+		distance.index = index
+		distance._summary = self._tree_summary()
+
+		return distance
+
+
+	def nearest_relatives(self, identifiers, k=1, processes=None):
+		'''
+		For many organisms of interest at once, find the k organisms with minimal phylogenetic distance from the set of organisms.
+		Returns a dictionary with the organisms of interest as keys and lists of (organism, score) tuples as values, best first.
+		When there are ties at the k:th score the organisms closest in the taxonomy tree are picked.
+		All organisms share the same tree index. Large batches (10000 or more) are split over worker processes,
+		"processes" sets the number of workers, the default is to use all cores for large batches. Use 1 to avoid worker processes.
+		'''
+		assert k >= 1, 'Error, "k" must be at least 1'
+		identifiers = list(identifiers)
+		for identifier in identifiers:
+			assert identifier in self.leaf, 'Error, the identifier %s is not part of your input.' % identifier
+
+		# build the shared parts of the index before any workers are started
+		self._tree_summary()
+
+		if processes is None:
+			processes = os.cpu_count() if len(identifiers) >= 10000 else 1
+
+		if processes == 1:
+			return {identifier:self._nearest(identifier, k) for identifier in identifiers}
+
+		chunk_size = max(1, len(identifiers) // (processes * 4))
+		chunks = [identifiers[n:n+chunk_size] for n in range(0, len(identifiers), chunk_size)]
+		with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self._nearest_data(),)) as pool:
+			results = pool.map(_nearest_worker, [(chunk, k) for chunk in chunks])
+
+		out_data = {}
+		for result in results:
+			out_data.update(result)
+
+		return out_data
+
+
+	def _numpy_index(self):
+		'''
+		Get the parts of the index that are needed for vectorized scoring as NumPy arrays.
+		The sparse table levels are padded into a single two dimensional array.
+		'''
+		import numpy as np
+
+		if getattr(self, '_arrays', None) is None:
+			table = np.zeros((len(self.index.table), len(self.index.euler)), dtype=np.int32)
+			for k, level in enumerate(self.index.table):
+				table[k, :len(level)] = np.frombuffer(level, dtype=np.int32)
+
+			self._arrays = {'first':np.frombuffer(self.index.first, dtype=np.int32)[np.frombuffer(self.index.leaves, dtype=np.int32)],
+							'leaf_depths':np.frombuffer(self.index.depths, dtype=np.int32)[np.frombuffer(self.index.leaves, dtype=np.int32)],
+							'depths':np.frombuffer(self.index.depths, dtype=np.int32),
+							'node_scores':np.frombuffer(self.node_scores, dtype=np.uint8),
+							'table':table}
+
+		return self._arrays
+
+
+	def condensed_distance(self, batch_size=2**22, dtype='float64', processes=1):
+		'''
+		Compute the distance score between all pairs of organisms or taxids as a condensed distance matrix.
+		The layout is the same as that of scipy.spatial.distance.pdist, so the output can be passed directly to
+		scipy.cluster.hierarchy or expanded with scipy.spatial.distance.squareform.
+		The pairs are scored in vectorized batches of at most "batch_size" pairs.
+		With more than one process the index and the output are placed in shared memory and the batches are split over a process pool.
+		Returns the condensed matrix and a list of the identifiers in the order used.
+		'''
+		import numpy as np
+
+		arrays = self._numpy_index()
+		n = len(self.identifier_list)
+		batches = list(_row_batches(n, batch_size))
+
+		if processes == 1:
+			out_data = np.empty(n * (n - 1) // 2, dtype=dtype)
+			for start, stop in batches:
+				_fill_condensed(out_data, arrays, self.score_type, n, start, stop)
+
+			return out_data, list(self.identifier_list)
+
+		# every batch writes to its own part of the shared output, so the order in which they finish does not matter
+		blocks, specs = _share_arrays(dict(arrays, out=np.empty(n * (n - 1) // 2, dtype=dtype)))
+		try:
+			with multiprocessing.Pool(processes, initializer=_init_shared_worker, initargs=(specs, self.score_type, n)) as pool:
+				for finished in pool.imap_unordered(_condensed_worker, batches):
+					pass
+
+			out_block = blocks[list(specs.keys()).index('out')]
+			out_data = np.ndarray(specs['out'][1], dtype=specs['out'][2], buffer=out_block.buf).copy()
+		finally:
+			_release_arrays(blocks)
+
+		return out_data, list(self.identifier_list)
+
+
+	def memmap_distance(self, filepath, tile_size=1024, processes=1):
+		'''
+		Compute the distance score between all pairs of organisms or taxids into a square matrix on disk.
+		The matrix is stored as a memory-mapped .npy file (uint8 for 'rank' scores, float32 for 'length' scores)
+		and filled in tiles of tile_size by tile_size pairs, so memory use does not grow with the number of organisms.
+		The identifiers are written next to it in "<filepath>.identifiers" and the number of finished rows in "<filepath>.progress".
+		If the computation is interrupted, calling the method again with the same filepath resumes where it stopped.
+		With more than one process the rows of tiles are split over a process pool that shares the index.
+		Use load_distance() to read the finished matrix.
+		'''
+		import numpy as np
+
+		dtype = np.uint8 if self.score_type == 'rank' else np.float32
+		n = len(self.identifier_list)
+
+		# see whether there is an unfinished matrix for the same identifiers to continue on
+		done = 0
+		if isfile(filepath) and isfile(filepath + '.progress') and isfile(filepath + '.identifiers'):
+			with open(filepath + '.identifiers', 'r') as f:
+				identifiers = f.read().split('\n')
+			with open(filepath + '.progress', 'r') as f:
+				done = int(f.read())
+
+			matrix = np.lib.format.open_memmap(filepath, mode='r+') if identifiers == self.identifier_list else None
+			if matrix is not None and matrix.shape == (n, n) and matrix.dtype == dtype:
+				print('Resuming distance computation at row %s of %s' % (done, n))
+			else:
+				print('The matrix in %s is for other identifiers or another score type, starting a new one' % filepath)
+				del matrix
+				done = 0
+
+		if done == 0:
+			with open(filepath + '.identifiers', 'w') as f:
+				f.write('\n'.join(self.identifier_list))
+			matrix = np.lib.format.open_memmap(filepath, mode='w+', dtype=dtype, shape=(n, n))
+			_write_progress(filepath, 0)
+
+		row_tiles = [(start, min(start + tile_size, n)) for start in range(done, n, tile_size)]
+
+		if processes == 1:
+			arrays = self._numpy_index()
+			for start, stop in row_tiles:
+				_fill_tile_rows(matrix, arrays, self.score_type, start, stop, tile_size)
+				matrix.flush()
+				_write_progress(filepath, stop)
+				print('Computed distances for row %s of %s' % (stop, n))
+
+			del matrix
+			return
+
+		# the workers open the file themselves, results come back in order so that the progress only covers finished rows
+		del matrix
+		blocks, specs = _share_arrays(self._numpy_index())
+		try:
+			with multiprocessing.Pool(processes, initializer=_init_shared_worker, initargs=(specs, self.score_type, n)) as pool:
+				for stop in pool.imap(_memmap_worker, [(filepath, start, stop, tile_size) for start, stop in row_tiles]):
+					_write_progress(filepath, stop)
+					print('Computed distances for row %s of %s' % (stop, n))
+		finally:
+			_release_arrays(blocks)
 
 
 	def all_distance_data(self):
@@ -480,10 +1597,11 @@ class Distance(object):
 		for combo in input_combos:
 
 			# Find the common node
-			result = self._find_common_taxid(self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
+			node = self._find_common_node(combo[0], combo[1])
+			result = self._node_data(node)
 
 			# Get the distance score
-			result['score'] = self._distance_score(result['rank'], self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
+			result['score'] = self._distance_score(node, combo[0], combo[1])
 
 			# what follows will duplicate the data but it's nessecary for convenience
 
@@ -510,10 +1628,7 @@ class Distance(object):
 		#TODO
 		# need to normalize the names
 
-		result = self._find_common_taxid(self.lin_data.lineage(identifier1), self.lin_data.lineage(identifier2))
-
-		# Get the distance score
-		score = self._distance_score(result['rank'], self.lin_data.lineage(identifier1), self.lin_data.lineage(identifier2))
+		score = self._pair_score(identifier1, identifier2)
 
 		return {'score':score,'pairs':[(identifier1, identifier2)]}
 
@@ -522,29 +1637,9 @@ class Distance(object):
 		'''
 		Find the minial phylogenetic distance score in a set of organisms or taxids.
 		'''
-		best_score = float('Inf')
-		best_combos = []
-
-		# make all possible organism pairs
-		input_combos = self._combine_all()
-
-		for combo in input_combos:
-
-			# Find the common node
-			result = self._find_common_taxid(self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			# Get the distance score
-			result['score'] = self._distance_score(result['rank'], self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			if result['score'] == best_score:
-				best_combos.append(combo)
-
-			elif result['score'] < best_score:
-				best_score = result['score']
-				best_combos = [combo]
-
-			else:
-				continue
+		best_score, best_combos = self._extreme_pairs(smallest=True)
+		if best_score is None:
+			best_score = float('Inf')
 
 		return {'score':best_score,'pairs':best_combos}
 
@@ -553,29 +1648,9 @@ class Distance(object):
 		'''
 		Find the maximal phylogenetic distance score in a set of organisms or taxids.
 		'''
-		best_score = float('-Inf')
-		best_combos = []
-
-		# make all possible organism pairs
-		input_combos = self._combine_all()
-
-		for combo in input_combos:
-
-			# Find the common node
-			result = self._find_common_taxid(self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			# Get the distance score
-			result['score'] = self._distance_score(result['rank'], self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			if result['score'] == best_score:
-				best_combos.append(combo)
-
-			elif result['score'] > best_score:
-				best_score = result['score']
-				best_combos = [combo]
-
-			else:
-				continue
+		best_score, best_combos = self._extreme_pairs(smallest=False)
+		if best_score is None:
+			best_score = float('-Inf')
 
 		return {'score':best_score,'pairs':best_combos}
 
@@ -584,32 +1659,12 @@ class Distance(object):
 		'''
 		For an organism of interest, find the organism with minimal phylogenetic distance from a set of organisms.
 		'''
-		best_score = float('Inf')
-		best_combos = []
-
 		#TODO
 		# need to normalize the names
 
-		# make all possible organism pairs
-		input_combos = self._combine_target_with_all(identifier)
-
-		for combo in input_combos:
-
-			# Find the common node
-			result = self._find_common_taxid(self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			# Get the distance score
-			result['score'] = self._distance_score(result['rank'], self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			if result['score'] == best_score:
-				best_combos.append(combo)
-
-			elif result['score'] < best_score:
-				best_score = result['score']
-				best_combos = [combo]
-
-			else:
-				continue
+		best_score, best_combos = self._extreme_relatives(identifier, smallest=True)
+		if best_score is None:
+			best_score = float('Inf')
 
 		return {'score':best_score,'pairs':best_combos}
 
@@ -618,31 +1673,11 @@ class Distance(object):
 		'''
 		For an organism of interest, find the organism with maximal phylogenetic distance from a set of organisms.
 		'''
-		best_score = float('-Inf')
-		best_combos = []
-
 		#TODO
 		# need to normalize the names
 
-		# make all possible organism pairs
-		input_combos = self._combine_target_with_all(identifier)
-
-		for combo in input_combos:
-
-			# Find the common node
-			result = self._find_common_taxid(self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			# Get the distance score
-			result['score'] = self._distance_score(result['rank'], self.lin_data.lineage(combo[0]), self.lin_data.lineage(combo[1]))
-
-			if result['score'] == best_score:
-				best_combos.append(combo)
-
-			elif result['score'] > best_score:
-				best_score = result['score']
-				best_combos = [combo]
-
-			else:
-				continue
+		best_score, best_combos = self._extreme_relatives(identifier, smallest=False)
+		if best_score is None:
+			best_score = float('-Inf')
 
 		return {'score':best_score,'pairs':best_combos}
@@ -16,17 +16,49 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import gzip
+import itertools
+from collections.abc import Mapping
 from orgtools import org_tax, uid_tax, uid_pfam, org_ph, org_temp, helpfunctions
 
 
+class _Superkingdoms(Mapping):
+	'''
+	A read-only dictionary of taxid keys and superkingdom values,
+	where each superkingdom is only looked up (and its lineage resolved) when it is asked for.
+	'''
+	def __init__(self, lin_data):
+		self.lin_data = lin_data
+
+
+	def __getitem__(self, identifier):
+		if identifier not in self.lin_data.identifiers():
+			raise KeyError(identifier)
+		return self.lin_data.domain(identifier)
+
+
+	def __iter__(self):
+		return iter(self.lin_data.identifiers())
+
+
+	def __len__(self):
+		return len(self.lin_data.identifiers())
+
+
+
 class Properties(object):
 	'''
 	A class holding methods for getting properties for uniprot identifiers.
+	With lazy=True the lineages and superkingdoms are only worked out for the taxids that are asked for.
 	'''
-	def __init__(self, uid_list):
+	# the columns of the output flatfile
+	COLUMNS = ['uid', 'taxid', 'organism', 'superkingdom', 'ph', 'temperature', 'pfam', 'lineage_identifiers', 'lineage_ranks', 'lineage_names']
+
+	def __init__(self, uid_list, lazy=False):
 		assert type(uid_list) in [list, set], 'Error, the input variable "uid_list" must contain a list or a set.'
 
 		self.uniprot_ids = uid_list
+		self.lazy = lazy
 
 		self.taxonomy_ids = self.taxid_from_uid() # get a dictionary mapping uniprot identifiers to taxonomy ids
 
@@ -74,7 +106,7 @@ class Properties(object):
 		if None in tax_vals:
 			tax_vals.remove(None)
 
-		result = org_tax.Lineage(input_type='taxid', input_list=tax_vals)
+		result = org_tax.Lineage(input_type='taxid', input_list=tax_vals, lazy=self.lazy)
 		return result
 
 
@@ -82,9 +114,21 @@ class Properties(object):
 		'''
 		Get domain of life (superkingdom) from taxonomic lineage.
 		'''
+		if self.lazy:
+			return _Superkingdoms(self.lin_data)
+
+		identifiers = list(self.lin_data.identifiers())
+
+		# project all taxids onto the superkingdom rank at once when NumPy is available
+		try:
+			columns = org_tax.rank_columns(identifiers, ranks=['superkingdom'], taxonomy=self.lin_data.taxonomy)
+		except ImportError:
+			columns = {'superkingdom_name': [None] * len(identifiers)}
+
 		data = {}
-		for identifier in self.lin_data.identifiers():
-			data[identifier] = self.lin_data.domain(identifier)
+		for identifier, name in zip(identifiers, columns['superkingdom_name']):
+			# taxids without a superkingdom are handled by the lineage object, as before
+			data[identifier] = self.lin_data.domain(identifier) if name is None else name
 		return data
 
 
@@ -120,15 +164,11 @@ class Properties(object):
 		return result
 
 
-	def flatfile(self, filepath):
+	def _records(self):
 		'''
-		Output all the data in a flatfile for future use.
+		Generate one record per uniprot identifier, in input order.
+		Values that are missing are None, the pfam domains and lineage parts are lists.
 		'''
-		out_data = []
-		out_data.append('uid\ttaxid\torganism\tsuperkingdom\tph\ttemperature\tpfam\tlineage_identifiers\tlineage_ranks\tlineage_names')
-
-		missing_val = 'NA'
-
 		for uid in self.uniprot_ids:
 			taxid = self.taxonomy_ids.get(uid)
 			org = self.organism_names.get(taxid)
@@ -138,51 +178,106 @@ class Properties(object):
 			temperature = self.temperature.get(org)
 			ph = self.ph.get(org)
 
-			if taxid is None:
-				taxid = missing_val
-
-			if org is None:
-				org = missing_val
-
-
 			if lineage is None:
-				nodes = missing_val
-				ranks = missing_val
-				names = missing_val
+				nodes, ranks, names = None, None, None
 
 			elif lineage['nodes'] in ['None', None] or lineage['ranks'] is None:
-				nodes = missing_val
-				ranks = missing_val
-				names = missing_val
+				nodes, ranks, names = None, None, None
 
 			elif lineage['nodes'][0] == 'None' or None in lineage['ranks']:
-				nodes = missing_val
-				ranks = missing_val
-				names = missing_val
+				nodes, ranks, names = None, None, None
 
 			else:
-				nodes = ', '.join(lineage['nodes'])
-				ranks = ', '.join(lineage['ranks'])
-				names = ', '.join(lineage['names'])
+				nodes, ranks, names = list(lineage['nodes']), list(lineage['ranks']), list(lineage['names'])
 
-			if superkingdom is None:
-				superkingdom = missing_val
+			if pfam is not None:
+				pfam = sorted(pfam)
 
-			if pfam is None:
-				pfam = missing_val
-			else:
-				pfam = ', '.join(sorted(pfam))
+			yield (uid, taxid, org, superkingdom, ph, temperature, pfam, nodes, ranks, names)
+
+
+	def _write_tsv(self, f):
+		'''
+		Write the records as tab separated lines, one at a time.
+		'''
+		missing_val = 'NA'
+
+		f.write('\t'.join(self.COLUMNS))
+		for record in self._records():
+			values = []
+			for value in record:
+				if value is None:
+					value = missing_val
+				elif type(value) is list:
+					value = ', '.join(value)
+				values.append(str(value))
+
+			f.write('\n' + '\t'.join(values))
 
-			if temperature is None:
-				temperature = missing_val
 
-			if ph is None:
-				ph = missing_val
+	def _write_columnar(self, filepath, file_format, batch_size):
+		'''
+		Write the records to a Parquet or Arrow IPC file with typed columns, one batch of rows at a time.
+		'''
+		import pyarrow as pa
+
+		schema = pa.schema([('uid', pa.string()),
+							('taxid', pa.int64()),
+							('organism', pa.string()),
+							('superkingdom', pa.string()),
+							('ph', pa.float64()),
+							('temperature', pa.float64()),
+							('pfam', pa.list_(pa.string())),
+							('lineage_identifiers', pa.list_(pa.int64())),
+							('lineage_ranks', pa.list_(pa.string())),
+							('lineage_names', pa.list_(pa.string()))])
+
+		if file_format == 'parquet':
+			import pyarrow.parquet as pq
+			writer = pq.ParquetWriter(filepath, schema)
+		else:
+			writer = pa.ipc.new_file(filepath, schema)
+
+		def _to_int(value):
+			value = str(value)
+			return int(value) if value.isdigit() else None
+
+		with writer:
+			batch = []
+			for record in itertools.chain(self._records(), [None]):
+				if record is not None:
+					uid, taxid, org, superkingdom, ph, temperature, pfam, nodes, ranks, names = record
+					if nodes is not None:
+						nodes = [_to_int(s) for s in nodes]
+					batch.append((uid, None if taxid is None else _to_int(taxid), org, superkingdom,
+								None if ph is None else float(ph), None if temperature is None else float(temperature),
+								pfam, nodes, ranks, names))
+
+				if len(batch) == batch_size or (record is None and batch):
+					columns = [pa.array(column, type=schema.field(i).type) for i, column in enumerate(zip(*batch))]
+					writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+					batch = []
+
+
+	def flatfile(self, filepath, file_format='tsv', batch_size=100000):
+		'''
+		Output all the data in a flatfile for future use.
+		Rows are written as they are produced, so the full output is never held in memory.
+		The file_format can be 'tsv' (gzip compressed if the filepath ends with .gz), 'parquet' or 'arrow' (Arrow IPC).
+		The columnar formats have typed columns and are written in batches of batch_size rows, they require pyarrow.
+		'''
+		assert file_format in ['tsv', 'parquet', 'arrow'], 'Error, "file_format" must be "tsv", "parquet" or "arrow"'
+
+		if file_format != 'tsv':
+			self._write_columnar(filepath, file_format, batch_size)
 
-			out_data.append('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s' % (uid, taxid, org, superkingdom, ph, temperature, pfam, nodes, ranks, names))
+		elif filepath.endswith('.gz'):
+			with gzip.open(filepath, 'wt') as f:
+				self._write_tsv(f)
 
-		with open(filepath, 'w') as f:
-			f.write('\n'.join(out_data))
+		else:
+			with open(filepath, 'w') as f:
+				self._write_tsv(f)
 
 
 	def network(self, filepath):
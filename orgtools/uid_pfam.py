@@ -15,9 +15,19 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import time
+import gzip
+import heapq
+import itertools
+import os
 import re
-import requests
+import sqlite3
+from os.path import isfile, exists
+from pkg_resources import resource_filename
+from orgtools import uid_tax, uniprot_api, uniprot_cache
+
+
+PFAM_DB = 'data/pfam_data/pfam.db'
+PFAM_REGEX = re.compile(b'PF[0-9]{5}')
 
 
 def _retreive_info(id_list):
@@ -26,9 +36,6 @@ def _retreive_info(id_list):
 	https://www.uniprot.org/help/uniprotkb_column_names
 	https://www.uniprot.org/help/uploadlists
 	'''
-
-	url = 'http://www.uniprot.org/uploadlists/'
-
 	params = {
 	'from':'ACC+ID',
 	'to':'ACC',
@@ -38,16 +45,7 @@ def _retreive_info(id_list):
 	}
 
 	#retreive mapping
-	response = requests.get(url, params=params)
-	if response.ok:
-		if response.text == '':
-			return None
-		else:
-			return response.text
-	else:
-		print('Unknown error in downloading pfam domain information at "%s"' % url)
-		return None
-
+	return uniprot_api.query(params)
 
 
 def _parse_line(line):
@@ -62,31 +60,70 @@ def _parse_line(line):
 	return uniprot_id, pfam
 
 
-def get_pfam(uid_list):
+def get_pfam(uid_list, use_cache=True, offline=False):
 	'''
 	Given as set of uniprot identifiers, downloads domain information from UniProt.
+	Results are kept in a local cache, only identifiers that are not in the cache are looked up at UniProt.
+	With offline=True the domains are taken from the local store built by build_from_release() instead.
 	'''
+	if offline:
+		return _get_pfam_from_store(uid_list)
 
-	out_data = {k:None for k in uid_list}
+	# threads that look up the same identifiers at the same time share the requests
+	if not use_cache:
+		result = _FLIGHTS.resolve(uid_list, lambda id_list: _get_pfam_from_uniprot(id_list)[0])
+		return {uid:result.get(uid) for uid in uid_list}
 
-	# chunk the data up in batches
-	group_size = 100
-	list_length = len(uid_list)
-	for n in range(0, list_length, group_size):
+	# the domains are cached as sorted lists, or None for identifiers without domains
+	cache = uniprot_cache.Cache('pfam')
+	cached = cache.get_many(uid_list)
 
-		if n + group_size > list_length:
-			end = list_length
-		else:
-			end = n+group_size
-		batch = uid_list[n:end]
+	missing = [uid for uid in uid_list if uid not in cached]
+	if missing:
+		print('%s of %s id numbers were found in the cache' % (len(uid_list) - len(missing), len(uid_list)))
+		cached.update(_FLIGHTS.resolve(missing, lambda id_list: _get_pfam_from_uniprot_cached(id_list, cache)))
+
+	out_data = {}
+	for uid in uid_list:
+		value = cached.get(uid)
+		out_data[uid] = None if value is None else set(value)
+
+	return out_data
 
-		# download a batch
-		print('Retrieving domain for id numbers %s to %s ...' % (n, end))
-		page = None
-		while page is None:
-			page = _retreive_info(batch)
-			if page is None:
-				time.sleep(1)
+
+_FLIGHTS = uniprot_api.SingleFlight()
+
+def _get_pfam_from_uniprot_cached(uid_list, cache):
+	'''
+	Look up domains at UniProt and store the result in the cache.
+	'''
+	result, failed = _get_pfam_from_uniprot(uid_list)
+
+	# identifiers in batches that could not be retrieved are not cached, so that they are tried again next time
+	failed = set(failed)
+	cache.set_many({uid:None if result.get(uid) is None else sorted(result[uid]) for uid in uid_list if uid not in failed})
+	return result
+
+
+def _get_pfam_from_uniprot(uid_list):
+	'''
+	Given as set of uniprot identifiers, downloads domain information from UniProt.
+	The identifiers are sent in batches, several batches are downloaded at the same time.
+	Returns the domains and a list of the identifiers that could not be retrieved.
+	'''
+
+	out_data = {k:None for k in uid_list}
+	failed = []
+
+	# the batch size adapts to how fast UniProt answers
+	scheduler = uniprot_api.Scheduler(group_size=100)
+
+	# download the batches, the pages come back in the same order as the batches
+	print('Retrieving domains for %s id numbers ...' % len(out_data))
+	for batch, page in scheduler.run(_retreive_info, uid_list):
+		if page is None:
+			failed.extend(batch)
+			continue
 
 		# now parse the page
 		first_skipped = False
@@ -104,8 +141,314 @@ def get_pfam(uid_list):
 				pfam_domain = None
 
 			# add to the data structure
-			if out_data.get(identifier) is None:
-				out_data[identifier] = set([])
 			out_data[identifier] = pfam_domain
+
+	if failed:
+		print('Could not retrieve %s id numbers from UniProt' % len(failed))
+	print('Done')
+	return out_data, failed
+
+
+def _parse_regions_chunk(chunk):
+	'''
+	Get the uid and Pfam family of each line in a chunk of a Pfam-A regions file (Pfam-A.regions.uniprot.tsv),
+	where the uid is in the first column and the Pfam family (for example PF00001) in one of the other ones.
+	Returns the size of the chunk and the uid/Pfam lines sorted on uid.
+	'''
+	out_data = []
+	for line in chunk.split(b'\n'):
+		parts = line.split(b'\t')
+		for part in parts[1:]:
+			# drop the version, if any (PF00001.21)
+			pfam = part.split(b'.')[0]
+			if PFAM_REGEX.fullmatch(pfam):
+				out_data.append(b'%s\t%s\n' % (parts[0], pfam))
+				break
+
+	out_data.sort()
+	return len(chunk), out_data
+
+
+def _parse_dat_chunk(chunk):
+	'''
+	Get the uids and Pfam families from the entries in a chunk of a UniProt dat file,
+	using the "AC   P12345; Q9XXX1;" and "DR   Pfam; PF00001; 7tm_1; 1." lines.
+	All accessions of an entry, the primary as well as the secondary ones, are mapped to its Pfam families.
+	Returns the size of the chunk and the uid/Pfam lines sorted on uid.
+	'''
+	out_data = []
+	uids = []
+	for line in chunk.split(b'\n'):
+		if line.startswith(b'AC   '):
+			uids.extend(s.strip() for s in line[5:].split(b';') if s.strip())
+
+		elif line.startswith(b'DR   Pfam;'):
+			pfam = line.split(b';')[1].strip()
+			out_data.extend(b'%s\t%s\n' % (uid, pfam) for uid in uids)
+
+		elif line.startswith(b'//'):
+			uids = []
+
+	out_data.sort()
+	return len(chunk), out_data
+
+
+def build_from_release(filepaths, processes=None, chunk_size=2**24, run_size=10**7):
+	'''
+	Build a local store of Pfam domains, so that domains can be found without network access.
+	Takes a list of Pfam-A regions files (Pfam-A.regions.uniprot.tsv) or UniProt dat files (using the "DR   Pfam;" lines),
+	these may be gzipped. The format is recognized from the first characters of the file.
+	The files are parsed in parallel and replace the SQLite database that get_pfam() uses with offline=True.
+	'''
+	if isinstance(filepaths, str):
+		filepaths = [filepaths]
+	if processes is None:
+		processes = os.cpu_count()
+
+	folder = resource_filename(__name__, 'data/pfam_data/')
+	if not exists(folder):
+		os.makedirs(folder)
+
+	run_files = []
+	for filepath in filepaths:
+		with (gzip.open(filepath, 'rb') if filepath.endswith('.gz') else open(filepath, 'rb')) as f:
+			first = f.read(5)
+
+		if first == b'ID   ':
+			worker, separator = _parse_dat_chunk, b'\n//\n'
+		else:
+			worker, separator = _parse_regions_chunk, b'\n'
+
+		print('Parsing "%s" ...' % filepath)
+		runs, _, _ = uid_tax._sorted_runs(filepath, worker, folder, processes, chunk_size, run_size, separator)
+		run_files.extend(runs)
+
+	# merge the runs and store the sorted domains of each uid on a single row
+	print('Merging %s sorted runs ...' % len(run_files))
+	runs = [open(s, 'rb') for s in run_files]
+	def _rows():
+		lines = (line.decode('utf-8').strip().split('\t') for line in heapq.merge(*runs))
+		for uid, group in itertools.groupby(lines, key=lambda parts: parts[0]):
+			yield uid, ' '.join(sorted(set(parts[1] for parts in group)))
+
+	filepath = resource_filename(__name__, PFAM_DB)
+	temp_filepath = filepath + '.tmp'
+	if exists(temp_filepath):
+		os.remove(temp_filepath)
+
+	con = sqlite3.connect(temp_filepath)
+	con.execute('CREATE TABLE domains (uid TEXT PRIMARY KEY, pfam TEXT) WITHOUT ROWID')
+	con.executemany('INSERT INTO domains VALUES (?, ?)', _rows())
+	con.commit()
+	con.close()
+	os.replace(temp_filepath, filepath)
+
+	for run_file, run_filepath in zip(runs, run_files):
+		run_file.close()
+		os.remove(run_filepath)
+
 	print('Done')
+
+
+def _get_pfam_from_store(uid_list):
+	'''
+	Given as set of uniprot identifiers, looks up the domains in the local store built by build_from_release().
+	'''
+	filepath = resource_filename(__name__, PFAM_DB)
+	assert isfile(filepath), 'Error, there is no local Pfam store at "%s", build it with build_from_release()' % filepath
+
+	out_data = {k:None for k in uid_list}
+	uid_set = list(set(uid_list))
+
+	con = sqlite3.connect(filepath)
+	for n in range(0, len(uid_set), 500):
+		chunk = uid_set[n:n+500]
+		for uid, pfam in con.execute('SELECT uid, pfam FROM domains WHERE uid IN (%s)' % ','.join('?' * len(chunk)), chunk):
+			out_data[uid] = set(pfam.split(' '))
+	con.close()
+
 	return out_data
+
+
+class PfamIndex(object):
+	'''
+	An inverted index from Pfam family to the proteins that carry it, for set queries over many proteins.
+	Built from the output of get_pfam() ({uid: set or None}) or from the local store.
+	Each family is kept as a sorted array of protein numbers when it is rare,
+	and as a bitset with one bit per protein (numpy.packbits) when that is smaller.
+	Requires NumPy.
+	'''
+	def __init__(self, pfam_data):
+		import numpy as np
+
+		self.uids = list(pfam_data.keys())
+		self.size = len(self.uids)
+
+		# one (protein, family) pair per annotation
+		families = {}
+		proteins = []
+		codes = []
+		for n, uid in enumerate(self.uids):
+			for pfam in pfam_data[uid] or ():
+				proteins.append(n)
+				codes.append(families.setdefault(pfam, len(families)))
+
+		self.families = list(families.keys())
+		proteins = np.array(proteins, dtype=np.uint32)
+		codes = np.array(codes, dtype=np.uint32)
+
+		# group the proteins by family, the stable sort keeps them in order within each family
+		order = np.argsort(codes, kind='stable')
+		bounds = np.searchsorted(codes[order], np.arange(len(self.families) + 1))
+		self.index = {}
+		for code, pfam in enumerate(self.families):
+			members = proteins[order[bounds[code]:bounds[code+1]]]
+
+			# an array of 4-byte numbers is smaller than a bitset for less than one protein in 32
+			if len(members) * 32 < self.size:
+				self.index[pfam] = members
+			else:
+				bits = np.zeros(self.size, dtype=bool)
+				bits[members] = True
+				self.index[pfam] = np.packbits(bits)
+
+
+	@classmethod
+	def from_store(cls, uid_list=None):
+		'''
+		Build the index from the local store built by build_from_release(),
+		either for all the proteins in it or for a list of uids.
+		'''
+		if uid_list is not None:
+			return cls(_get_pfam_from_store(uid_list))
+
+		filepath = resource_filename(__name__, PFAM_DB)
+		assert isfile(filepath), 'Error, there is no local Pfam store at "%s", build it with build_from_release()' % filepath
+
+		con = sqlite3.connect(filepath)
+		pfam_data = {uid:pfam.split(' ') for uid, pfam in con.execute('SELECT uid, pfam FROM domains')}
+		con.close()
+
+		return cls(pfam_data)
+
+
+	def __contains__(self, pfam):
+		return pfam in self.index
+
+
+	def _bitset(self, pfam):
+		'''
+		The proteins with a family, as a bitset.
+		'''
+		import numpy as np
+
+		members = self.index.get(pfam)
+		if members is None:
+			return np.zeros((self.size + 7) // 8, dtype=np.uint8)
+		elif members.dtype == np.uint8:
+			return members
+
+		bits = np.zeros(self.size, dtype=bool)
+		bits[members] = True
+		return np.packbits(bits)
+
+
+	def _indices(self, pfam):
+		'''
+		The proteins with a family, as a sorted array of protein numbers.
+		'''
+		import numpy as np
+
+		members = self.index.get(pfam)
+		if members is None:
+			return np.zeros(0, dtype=np.uint32)
+		elif members.dtype == np.uint8:
+			return np.flatnonzero(np.unpackbits(members, count=self.size)).astype(np.uint32)
+
+		return members
+
+
+	def _query_bits(self, all_of=(), any_of=(), none_of=()):
+		'''
+		A bitset of the proteins that have all the families in all_of, at least one of the families in any_of
+		(if any are given) and none of the families in none_of.
+		'''
+		import numpy as np
+
+		# start from all proteins, the padding bits at the end are left unset
+		bits = np.packbits(np.ones(self.size, dtype=bool))
+
+		for pfam in all_of:
+			bits &= self._bitset(pfam)
+
+		if any_of:
+			either = np.zeros_like(bits)
+			for pfam in any_of:
+				either |= self._bitset(pfam)
+			bits &= either
+
+		for pfam in none_of:
+			bits &= ~self._bitset(pfam)
+
+		return bits
+
+
+	def query(self, all_of=(), any_of=(), none_of=()):
+		'''
+		Get the uids of the proteins that have all the families in all_of, at least one of the families in any_of
+		(if any are given) and none of the families in none_of.
+		For example query(all_of=['PF00106'], none_of=['PF13561']).
+		'''
+		import numpy as np
+
+		bits = self._query_bits(_as_list(all_of), _as_list(any_of), _as_list(none_of))
+		return [self.uids[n] for n in np.flatnonzero(np.unpackbits(bits, count=self.size))]
+
+
+	def count(self, all_of=(), any_of=(), none_of=()):
+		'''
+		Count the proteins that match a query, see query().
+		'''
+		import numpy as np
+
+		bits = self._query_bits(_as_list(all_of), _as_list(any_of), _as_list(none_of))
+		return int(np.unpackbits(bits, count=self.size).sum())
+
+
+	def cooccurrence(self, pfam_list):
+		'''
+		Count how many proteins carry each pair of families, for a list of families.
+		Returns the list of families and a square matrix of counts in the same order,
+		the diagonal holds the number of proteins with each family.
+		The matrix is dense, so the list should be limited to the families of interest (all ~20k Pfam families would take several GB).
+		'''
+		import numpy as np
+
+		pfam_list = _as_list(pfam_list)
+
+		# the families of each protein, as rows of a sparse matrix
+		members = [self._indices(pfam) for pfam in pfam_list]
+		proteins = np.concatenate(members + [np.zeros(0, dtype=np.uint32)]).astype(np.int64)
+		codes = np.repeat(np.arange(len(pfam_list)), [len(s) for s in members])
+		order = np.argsort(proteins, kind='stable')
+		codes = codes[order]
+		indptr = np.concatenate(([0], np.cumsum(np.bincount(proteins, minlength=self.size))))
+
+		# for each family, count the families of the proteins that carry it
+		counts = np.zeros((len(pfam_list), len(pfam_list)), dtype=np.int64)
+		for n, rows in enumerate(members):
+			starts = indptr[rows]
+			lengths = indptr[rows + 1] - starts
+			positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+			counts[n] = np.bincount(codes[positions], minlength=len(pfam_list))
+
+		return pfam_list, counts
+
+
+def _as_list(pfam_list):
+	'''
+	Accept a single family as well as a list of them.
+	'''
+	if isinstance(pfam_list, str):
+		return [pfam_list]
+	return list(pfam_list)
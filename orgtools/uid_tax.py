@@ -16,13 +16,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import functools
 import gzip
+import heapq
+import multiprocessing
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
 from pkg_resources import resource_stream, resource_filename, resource_exists
 import os
-from os.path import isfile, exists
+from os.path import isfile, exists, getmtime
+import re
 
 import time
-import requests
+from orgtools import uniprot_api, uniprot_cache
+from orgtools.bloom import BloomFilter
 
 
 ################################## Depricated ######################################
@@ -30,6 +40,8 @@ import requests
 # Set up variables to keep track of the NCBI files
 RAW_FILE = 'data/uniprot_data/idmapping.dat.2015_03.gz'
 FILTERED_FILE = 'data/uniprot_data/filtered_idmapping.tsv'
+FILTERED_DB = 'data/uniprot_data/filtered_idmapping.db'
+FILTERED_BLOOM = 'data/uniprot_data/filtered_idmapping.bloom'
 
 
 def _download_file():
@@ -48,28 +60,253 @@ def _download_file():
 	print('Done')
 
 
-def _filter_file():
+def _read_chunks(stream, chunk_size, separator=b'\n'):
+	'''
+	Read a binary stream in chunks of roughly chunk_size bytes that end at a separator (by default a line break).
+	'''
+	rest = b''
+	while True:
+		data = stream.read(chunk_size)
+		if not data:
+			break
+
+		data = rest + data
+		end = data.rfind(separator)
+		end = 0 if end == -1 else end + len(separator)
+		rest = data[end:]
+		if end:
+			yield data[:end]
+
+	if rest:
+		yield rest
+
+
+def _filter_chunk(chunk):
+	'''
+	Keep the uid and taxid of the NCBI_TaxID lines in a chunk of the idmapping file.
+	Returns the size of the chunk and the lines sorted on uid.
+	'''
+	out_data = []
+	for line in chunk.split(b'\n'):
+		parts = line.split(b'\t')
+		if len(parts) == 3 and parts[1] == b'NCBI_TaxID':
+			out_data.append(b'%s\t%s\n' % (parts[0], parts[2].strip()))
+
+	out_data.sort()
+	return len(chunk), out_data
+
+
+def _open_decompressed(filepath):
+	'''
+	Open a file for reading in binary mode.
+	Gzipped files are decompressed by a separate process (pigz if it is installed, otherwise gzip).
+	Returns the stream and the decompressing process, or None if the file is not compressed.
+	'''
+	if not filepath.endswith('.gz'):
+		return open(filepath, 'rb'), None
+
+	decompressor = 'pigz' if shutil.which('pigz') is not None else 'gzip'
+	unzip = subprocess.Popen([decompressor, '-dc', filepath], stdout=subprocess.PIPE)
+	return unzip.stdout, unzip
+
+
+def _sorted_runs(filepath, worker, folder, processes, chunk_size, run_size, separator=b'\n'):
+	'''
+	Read a file in chunks that are handed to a pool of worker processes.
+	Each worker returns the size of its chunk and the uid/taxid lines it found.
+	These lines are sorted in runs of run_size lines that are kept in temporary files in the folder.
+	Returns the filepaths of the runs, the number of bytes read and the number of lines kept.
+	'''
+	stream, unzip = _open_decompressed(filepath)
+
+	# never hand out more chunks than the workers can keep up with, the decompression is usually faster
+	in_flight = threading.BoundedSemaphore(processes * 2)
+	def _bounded(chunks):
+		for chunk in chunks:
+			in_flight.acquire()
+			yield chunk
+
+	start_time = time.time()
+	bytes_read = 0
+	lines_kept = 0
+	run_files = []
+	run = []
+	with multiprocessing.Pool(processes) as pool:
+		for n, (size, lines) in enumerate(pool.imap(worker, _bounded(_read_chunks(stream, chunk_size, separator))), 1):
+			in_flight.release()
+			bytes_read += size
+			lines_kept += len(lines)
+			run.extend(lines)
+
+			if len(run) >= run_size:
+				run_files.append(_write_run(run, folder))
+				run = []
+
+			if n % 64 == 0:
+				elapsed = time.time() - start_time
+				print('Read %.0f MB (%.1f MB/s), kept %s lines (%.0f lines/s)' % (bytes_read / 1e6, bytes_read / 1e6 / elapsed, lines_kept, lines_kept / elapsed))
+
+	stream.close()
+	if unzip is not None:
+		assert unzip.wait() == 0, 'Error, could not decompress "%s"' % filepath
+	if run:
+		run_files.append(_write_run(run, folder))
+
+	print('Read %.0f MB from "%s" in %.0f s, kept %s lines' % (bytes_read / 1e6, filepath, time.time() - start_time, lines_kept))
+	return run_files, bytes_read, lines_kept
+
+
+def _write_run(lines, folder):
+	'''
+	Sort lines and write them to a temporary file in the folder, returns the filepath.
+	'''
+	lines.sort()
+	with tempfile.NamedTemporaryFile('wb', dir=folder, suffix='.run', delete=False) as f:
+		f.writelines(lines)
+
+	return f.name
+
+
+def _merge_runs(run_files):
+	'''
+	Merge sorted runs into the filtered flatfile, and write the SQLite database used for lookups in the same pass.
+	The runs are removed afterwards.
+	'''
+	print('Merging %s sorted runs ...' % len(run_files))
+	runs = [open(s, 'rb') for s in run_files]
+	with open(resource_filename(__name__, FILTERED_FILE), 'wb') as f:
+		def _rows():
+			for line in heapq.merge(*runs):
+				f.write(line)
+				uid, taxid = line.decode('utf-8').strip().split('\t')
+				yield uid, int(taxid)
+
+		_write_flatfile_index(_rows())
+
+	# the flatfile is closed after the database is written, make sure the database is not seen as out of date
+	os.utime(resource_filename(__name__, FILTERED_DB))
+
+	for run_file, filepath in zip(runs, run_files):
+		run_file.close()
+		os.remove(filepath)
+
+
+def _data_folder():
+	'''
+	Get the folder with the uniprot data, create it if needed.
+	'''
+	folder = resource_filename(__name__, 'data/uniprot_data/')
+	if not exists(folder):
+		os.makedirs(folder)
+
+	return folder
+
+
+def _filter_file(raw_filepath=None, processes=None, chunk_size=2**24, run_size=10**7):
 	'''
 	Filter everything out ot the uniprot flatfile that does not involve the translation between uid and taxid.
+	The file is decompressed by a separate process (pigz or gzip) and the chunks are filtered by a pool of worker processes.
+	The filtered lines are sorted on uid in runs of run_size lines that are kept in temporary files and merged at the end,
+	which writes the filtered flatfile and the SQLite database used for lookups in the same pass.
+	The downloaded flatfile is removed afterwards, a file that is passed as raw_filepath is left in place.
 	'''
 	print('The uniprot flatfile needs to be filtered to improve performance. Filtering...')
+	downloaded = raw_filepath is None
+	if downloaded:
+		raw_filepath = resource_filename(__name__, RAW_FILE)
+	if processes is None:
+		processes = os.cpu_count()
 
-	#open the idmapping file
-	with gzip.open(resource_filename(__name__, RAW_FILE), 'rb') as myzip, open(resource_filename(__name__, FILTERED_FILE), 'wb') as f:
+	run_files, _, _ = _sorted_runs(raw_filepath, _filter_chunk, _data_folder(), processes, chunk_size, run_size)
+	_merge_runs(run_files)
 
-		for line in myzip:
-			uid, database, value = line.split(b'\t')
+	# remove the zipfile, but only if it is the downloaded one
+	if downloaded:
+		print('Removing "%s"' % raw_filepath)
+		os.remove(raw_filepath)
 
-			if database != b'NCBI_TaxID':
-				continue
+	print('Done')
 
-			f.write(b'%s\t%s' % (uid, value))
 
-	# remove the zipfile
-	mycmd = 'rm %s' % resource_filename(__name__, RAW_FILE)
-	print(mycmd)
-	os.system(mycmd)
+def _parse_fasta_chunk(chunk):
+	'''
+	Get the uid and taxid from the headers in a chunk of a UniProt fasta file,
+	for example ">sp|P12345|AATM_RABIT Aspartate aminotransferase OS=Oryctolagus cuniculus OX=9986 GN=GOT2 PE=1 SV=2".
+	Returns the size of the chunk and the uid/taxid lines sorted on uid.
+	'''
+	out_data = []
+	for line in chunk.split(b'\n'):
+		if not line.startswith(b'>'):
+			continue
+
+		parts = line.split(b' ')
+		fields = parts[0].split(b'|')
+		uid = fields[1] if len(fields) >= 3 else fields[0][1:]
+		for part in parts[1:]:
+			if part.startswith(b'OX='):
+				out_data.append(b'%s\t%s\n' % (uid, part[3:]))
+				break
+
+	out_data.sort()
+	return len(chunk), out_data
+
+
+def _parse_dat_chunk(chunk):
+	'''
+	Get the uids and taxid from the entries in a chunk of a UniProt dat file,
+	using the "AC   P12345; Q9XXX1;" and "OX   NCBI_TaxID=9986;" lines.
+	All accessions of an entry, the primary as well as the secondary ones, are mapped to its taxid.
+	Returns the size of the chunk and the uid/taxid lines sorted on uid.
+	'''
+	out_data = []
+	uids = []
+	for line in chunk.split(b'\n'):
+		if line.startswith(b'AC   '):
+			uids.extend(s.strip() for s in line[5:].split(b';') if s.strip())
+
+		elif line.startswith(b'OX   ') and uids:
+			m = re.search(b'NCBI_TaxID=([0-9]+)', line)
+			if m is not None:
+				out_data.extend(b'%s\t%s\n' % (uid, m.group(1)) for uid in uids)
+			uids = []
+
+		elif line.startswith(b'//'):
+			uids = []
+
+	out_data.sort()
+	return len(chunk), out_data
+
+
+def build_from_release(filepaths, processes=None, chunk_size=2**24, run_size=10**7):
+	'''
+	Build the uid to taxid lookup from local UniProt release files, so that taxids can be found without network access.
+	Takes a list of uniprot_sprot/uniprot_trembl files in fasta (taxid from "OX=" in the headers) or dat format (taxid from the "OX" lines),
+	these may be gzipped. The format is recognized from the first character of the file.
+	The files are parsed in parallel and replace the filtered flatfile and the SQLite database that the flatfile lookup uses.
+	'''
+	if isinstance(filepaths, str):
+		filepaths = [filepaths]
+	if processes is None:
+		processes = os.cpu_count()
+
+	folder = _data_folder()
+	run_files = []
+	for filepath in filepaths:
+		with (gzip.open(filepath, 'rb') if filepath.endswith('.gz') else open(filepath, 'rb')) as f:
+			first = f.read(1)
+
+		if first == b'>':
+			worker, separator = _parse_fasta_chunk, b'\n'
+		elif first == b'I':
+			worker, separator = _parse_dat_chunk, b'\n//\n'
+		else:
+			raise ValueError('Error, "%s" is neither a UniProt fasta nor a dat file' % filepath)
 
+		print('Parsing "%s" ...' % filepath)
+		runs, _, _ = _sorted_runs(filepath, worker, folder, processes, chunk_size, run_size, separator)
+		run_files.extend(runs)
+
+	_merge_runs(run_files)
 	print('Done')
 
 
@@ -87,158 +324,183 @@ def _check_flatfile():
 
 
 
-def _get_taxid_from_flatfile(uid_list):
+def _write_flatfile_index(rows):
 	'''
-	Given a list of uids, looks up the taxonomic identifier for the organisms from which they originate.
-	Making use of a list ensures that the file only has to be scanned once.
-	Relies on a UniProt flatfile.
-	Returns a dictionary with UniprotId keys and taxid values.
+	Write an SQLite database with (uid, taxid) rows, indexed both on uid and on taxid.
+	The database is written to a temporary file first so that an interrupted build is never used.
 	'''
-	assert resource_exists(__name__, FILTERED_FILE), 'Error, could not find "filtered_idmapping.tsv" in the filepath %s' % resource_filename(__name__, FILTERED_FILE)
+	filepath = resource_filename(__name__, FILTERED_DB)
+	temp_filepath = filepath + '.tmp'
+	if exists(temp_filepath):
+		os.remove(temp_filepath)
 
-	uid_set = set(uid_list)
-	out_data = {key:None for key in uid_set}
+	con = sqlite3.connect(temp_filepath)
+	con.execute('CREATE TABLE mapping (uid TEXT, taxid INTEGER)')
+	con.executemany('INSERT INTO mapping VALUES (?, ?)', rows)
+	con.execute('CREATE INDEX mapping_uid ON mapping (uid)')
+	con.execute('CREATE INDEX mapping_taxid ON mapping (taxid)')
+	con.commit()
+	con.close()
 
-	# Go through the file line by line and search for matches
-	with open(resource_filename(__name__, FILTERED_FILE), 'r') as f:
-		for line in f:
-			uid, taxid, = line.strip().split('\t') #get data from the line
+	os.replace(temp_filepath, filepath)
 
-			# is it present in my list?
-			if uid in uid_set:
-				out_data[uid] = taxid
 
-	return out_data
+def _build_flatfile_index():
+	'''
+	Build the SQLite database from the filtered flatfile.
+	'''
+	print('Indexing the filtered uniprot flatfile. This only has to be done once...')
 
+	def _rows(f):
+		for line in f:
+			uid, taxid = line.strip().split('\t')
+			yield uid, int(taxid)
 
+	with open(resource_filename(__name__, FILTERED_FILE), 'r') as f:
+		_write_flatfile_index(_rows(f))
 
-def _get_uid_from_flatfile(taxid_list):
+	print('Done')
+
+
+def _check_flatfile_index():
 	'''
-	Given a list of taxonomic identifiers, looks up the UniprotIds associated with these.
-	Making use of a list ensures that the file only has to be scanned once.
-	Relies on a UniProt flatfile.
-	Returns a dictionary with taxid keys and a list of UniprotIds as values.
+	See whether the indexed flatfile is there, build it from the filtered flatfile if needed.
+	Returns the filepath of the database, or None if neither the database nor the filtered flatfile is available.
 	'''
-	assert resource_exists(__name__, FILTERED_FILE), 'Error, could not find "filtered_idmapping.tsv" in the filepath %s' % resource_filename(__name__, FILTERED_FILE)
+	filepath = resource_filename(__name__, FILTERED_DB)
+	flatfile = resource_filename(__name__, FILTERED_FILE)
 
-	taxid_set = set([str(x) for x in taxid_list])
-	out_data = {key:[] for key in taxid_set}
-
-	# Go through the file line by line and search for matches
-	with open(resource_filename(__name__, FILTERED_FILE), 'r') as f:
-		for line in f:
-			uid, taxid = line.strip().split('\t') #get data from the line
+	# use the database unless the flatfile has changed since it was built
+	if isfile(filepath) and (not isfile(flatfile) or getmtime(filepath) >= getmtime(flatfile)):
+		return filepath
 
-			# is it present in my list?
-			if taxid in taxid_set:
-				out_data[taxid].append(uid)
+	if not isfile(flatfile):
+		print('Could not find "filtered_idmapping.tsv" in the filepath %s, skipping the flatfile lookup' % resource_filename(__name__, FILTERED_FILE))
+		return None
 
-	return out_data
+	_build_flatfile_index()
+	return filepath
 
 
-# TODO
-# consider using sqlite database to speed up lookup
+def _query_flatfile_index(filepath, query, values):
+	'''
+	Run a query with an "IN (%s)" clause for a list of values, in batches that fit in a single parameterized query.
+	'''
+	con = sqlite3.connect(filepath)
+	for n in range(0, len(values), 500):
+		chunk = values[n:n+500]
+		for row in con.execute(query % ','.join('?' * len(chunk)), chunk):
+			yield row
+	con.close()
 
-import time
-from urllib import request, parse
-from urllib.error import URLError, HTTPError
-import re
 
+_FLATFILE_BLOOM = None
 
-def _dlfile(url):
+def _check_flatfile_bloom():
 	'''
-	Download specific url
+	Get a Bloom filter with all the uids in the indexed flatfile, build it if it is missing or out of date.
+	Returns None if the indexed flatfile is not available.
 	'''
-	page = None
-	while page is None:
-		try:
-			req = request.Request(url)
-			with request.urlopen(req) as response:
-				page = response.read()
+	global _FLATFILE_BLOOM
 
-		#handle errors
-		except HTTPError as e:
-			print("HTTP Error:", e.code, url)
-			page = None
-			time.sleep(2)
+	db_filepath = _check_flatfile_index()
+	if db_filepath is None:
+		return None
 
-		except URLError as e:
-			print("URL Error:", e.reason, url)
-			page = None
-			time.sleep(2)
+	filepath = resource_filename(__name__, FILTERED_BLOOM)
+	if not isfile(filepath) or getmtime(filepath) < getmtime(db_filepath):
+		print('Building a filter of the uids in the filtered uniprot flatfile. This only has to be done once...')
+		con = sqlite3.connect(db_filepath)
+		count = con.execute('SELECT COUNT(*) FROM mapping').fetchone()[0]
+		bloom = BloomFilter(count)
+		bloom.update(uid for (uid,) in con.execute('SELECT uid FROM mapping'))
+		con.close()
+		bloom.save(filepath)
+		_FLATFILE_BLOOM = None
+		print('Done')
 
-		except:
-			print('Unknown error when downloading url "%s"' % url)
-			page = None
-			time.sleep(2)
+	# keep the filter in memory as long as the file is unchanged
+	if _FLATFILE_BLOOM is None or _FLATFILE_BLOOM[0] != getmtime(filepath):
+		_FLATFILE_BLOOM = (getmtime(filepath), BloomFilter.load(filepath))
 
-	return page
+	return _FLATFILE_BLOOM[1]
 
 
-def _get_taxid_from_web(uid_list):
+def _get_taxid_from_flatfile(uid_list):
 	'''
-	Get taxids from uniprot identifiers by parsing the html code.
+	Given a list of uids, looks up the taxonomic identifier for the organisms from which they originate.
+	Relies on an SQLite database built from a UniProt flatfile.
+	Returns a dictionary with UniprotId keys and taxid values.
 	'''
-	out_data = {}
-	regex = b'class="entryID">.+?</td><td>([a-zA-Z0-9. - ]+)<br/>'
+	uid_set = set(uid_list)
+	out_data = {key:None for key in uid_set}
 
-	# look for each uid online
-	for uid in uid_list:
-		url = 'https://www.uniprot.org/uniparc/?query=%s' % uid
+	filepath = _check_flatfile_index()
+	if filepath is None:
+		return out_data
+
+	for uid, taxid in _query_flatfile_index(filepath, 'SELECT uid, taxid FROM mapping WHERE uid IN (%s) ORDER BY rowid', list(uid_set)):
+		out_data[uid] = str(taxid)
+
+	return out_data
 
-		# download page
-		page = _dlfile(url)
 
-		# see whether the page gives as hit
-		m = re.search(regex, page)
-		if m is not None:
-		    org = m.group(1)
-		else:
-			org = None
 
-		# update the out datafile
-		out_data[uid] = org
+def _get_uid_from_flatfile(taxid_list):
+	'''
+	Given a list of taxonomic identifiers, looks up the UniprotIds associated with these.
+	Relies on an SQLite database built from a UniProt flatfile.
+	Returns a dictionary with taxid keys and a list of UniprotIds as values.
+	'''
+	taxid_set = set([str(x) for x in taxid_list])
+	out_data = {key:[] for key in taxid_set}
+
+	filepath = _check_flatfile_index()
+	if filepath is None:
+		return out_data
+
+	numeric = [int(s) for s in taxid_set if s.isdigit()]
+	for taxid, uid in _query_flatfile_index(filepath, 'SELECT taxid, uid FROM mapping WHERE taxid IN (%s) ORDER BY rowid', numeric):
+		out_data[str(taxid)].append(uid)
 
 	return out_data
 
 
-def _find_missing(data_dict):
+def _flatfile_bloom_ready():
 	'''
-	If any of the identifiers did not get a taxid, try to find it from the flatfile.
-	Also test on-line lookup if there are still things missing.
+	See whether the indexed flatfile and its Bloom filter are already built and up to date.
 	'''
-	# first we try the flatefile
-	if None in data_dict.values():
-
-		# collect the offending identifiers
-		id_list = []
-		for key in data_dict.keys():
-			if data_dict[key] is None:
-				id_list.append(key)
+	db_filepath = resource_filename(__name__, FILTERED_DB)
+	bloom_filepath = resource_filename(__name__, FILTERED_BLOOM)
+	flatfile = resource_filename(__name__, FILTERED_FILE)
 
-		# look for them in the flatfile
-		out_data = _get_taxid_from_flatfile(id_list)
+	if not isfile(db_filepath) or not isfile(bloom_filepath):
+		return False
+	if isfile(flatfile) and getmtime(db_filepath) < getmtime(flatfile):
+		return False
+	return getmtime(bloom_filepath) >= getmtime(db_filepath)
 
-		# add the result to the original dict
-		for key in out_data.keys():
-			data_dict[key] = out_data[key]
 
-	# now we test on-line
-	if None in data_dict.values():
-		# collect the offending identifiers
-		id_list = []
-		for key in data_dict.keys():
-			if data_dict[key] is None:
-				id_list.append(key)
+def _get_taxid_from_local(uid_list, build=True):
+	'''
+	Look up uids in the indexed flatfile, if there is one.
+	Identifiers that are certainly not in the flatfile (according to its Bloom filter) are not looked up on disk.
+	With build=False the flatfile is only used if its database and Bloom filter have already been built,
+	otherwise nothing is built (or printed) and an empty dictionary is returned.
+	Returns a dictionary with the UniprotIds that were found as keys and taxid values.
+	'''
+	if not build and not _flatfile_bloom_ready():
+		return {}
 
-		# look for them in the flatfile
-		out_data = _get_taxid_from_web(id_list)
+	bloom = _check_flatfile_bloom()
+	if bloom is None:
+		return {}
 
-		# add the result to the original dict
-		for key in out_data.keys():
-			data_dict[key] = out_data[key]
+	maybe_local = [uid for uid in uid_list if uid in bloom]
+	if not maybe_local:
+		return {}
 
-	return data_dict
+	return {key:value for key, value in _get_taxid_from_flatfile(maybe_local).items() if value is not None}
 
 
 ############################################################################
@@ -251,9 +513,6 @@ def _retreive_info(id_list, from_db='ACC+ID', to_db='ACC'):
 	https://www.uniprot.org/help/api_idmapping
 	https://www.uniprot.org/help/uploadlists
 	'''
-
-	url = 'http://www.uniprot.org/uploadlists/'
-
 	params = {
 	'from':from_db,
 	'to':to_db,
@@ -263,16 +522,7 @@ def _retreive_info(id_list, from_db='ACC+ID', to_db='ACC'):
 	}
 
 	#retreive mapping
-	response = requests.get(url, params=params)
-	if response.ok:
-		if response.text == '':
-			return None
-		else:
-			return response.text
-	else:
-		print('Unknown error when mapping identifiers at UniProt')
-		print('Error msg: ', response)
-		return None
+	return uniprot_api.query(params)
 
 
 def _parse_page(page):
@@ -306,34 +556,88 @@ def _parse_page(page):
 	return out_data
 
 
-def get_taxid(uid_list):
+def get_taxid(uid_list, use_cache=True, offline=False):
 	'''
 	Given a list of uids, looks up the taxonomic identifier for the organisms from which they originate.
-	Making use of a list ensures that the file only has to be scanned once.
-	Relies on a UniProt flatfile.
+	Results are kept in a local cache, only identifiers that are not in the cache are looked up at UniProt.
+	Identifiers that UniProt does not give a taxid for are looked up in the indexed flatfile, if it has already been built.
+	With offline=True only the local flatfile lookup is used (see build_from_release()), nothing is sent to UniProt.
 	Returns a dictionary with UniprotId keys and taxid values.
 	'''
-	out_data = {}
+	if offline:
+		return _get_taxid_from_local(uid_list)
 
-	# chunk the data up in batches
-	group_size = 250
-	list_length = len(uid_list)
-	for n in range(0, list_length, group_size):
+	# threads that look up the same identifiers at the same time share the requests
+	if not use_cache:
+		out_data = _FLIGHTS.resolve(uid_list, lambda id_list: _get_taxid_from_uniprot(id_list)[0])
+		return _add_local_taxids(uid_list, out_data)
 
-		if n + group_size > list_length:
-			end = list_length
-		else:
-			end = n+group_size
-		batch = uid_list[n:end]
-
-		# download a batch
-		print('Retrieving taxids for UniprotId %s to %s from UniProtKb ...' % (n, end))
-		page = None
-		while page is None:
-			page = _retreive_info(batch, from_db='ACC+ID', to_db='ACC')
-			if page is None:
-				time.sleep(1)
-		print('Done')
+	# identifiers that UniProt did not know about are cached as None, they are not looked up at UniProt again
+	cache = uniprot_cache.Cache('taxid')
+	cached = cache.get_many(uid_list)
+	out_data = {key:value for key, value in cached.items() if value is not None}
+
+	missing = [uid for uid in uid_list if uid not in cached]
+	if missing:
+		print('%s of %s UniprotIds were found in the cache' % (len(uid_list) - len(missing), len(uid_list)))
+		out_data.update(_FLIGHTS.resolve(missing, lambda id_list: _get_taxid_from_uniprot_cached(id_list, cache)))
+
+	out_data = _add_local_taxids(uid_list, out_data)
+
+	dead = [uid for uid in cached if cached[uid] is None and uid not in out_data]
+	if dead:
+		print('%s UniprotIds are known to be missing from UniProt and cannot be resolved' % len(dead))
+
+	return out_data
+
+
+def _add_local_taxids(uid_list, out_data):
+	'''
+	Fill in the uids that UniProt did not give a taxid for from the indexed flatfile, if it has already been built.
+	'''
+	unresolved = [uid for uid in uid_list if uid not in out_data]
+	if unresolved:
+		out_data.update(_get_taxid_from_local(unresolved, build=False))
+
+	return out_data
+
+
+_FLIGHTS = uniprot_api.SingleFlight()
+
+def _get_taxid_from_uniprot_cached(uid_list, cache):
+	'''
+	Look up uids at UniProt and store the result in the cache.
+	'''
+	result, failed = _get_taxid_from_uniprot(uid_list)
+
+	# identifiers in batches that could not be retrieved are not cached, so that they are tried again next time
+	failed = set(failed)
+	cache.set_many({uid:result.get(uid) for uid in uid_list if uid not in failed})
+	return result
+
+
+def _get_taxid_from_uniprot(uid_list):
+	'''
+	Given a list of uids, looks up the taxonomic identifier for the organisms from which they originate.
+	The identifiers are sent to UniProt in batches, several batches are downloaded at the same time.
+	Returns a dictionary with UniprotId keys and taxid values, and a list of the identifiers that could not be retrieved.
+	'''
+	out_data = {}
+	failed = []
+	obsolete = []
+
+	# the batch size adapts to how fast UniProt answers
+	scheduler = uniprot_api.Scheduler(group_size=250)
+
+	# download the batches, the pages come back in the same order as the batches
+	print('Retrieving taxids for %s UniprotIds from UniProtKb ...' % len(uid_list))
+	done = 0
+	for batch, page in scheduler.run(_retreive_info, uid_list):
+		print('Retrieved taxids for UniprotId %s to %s' % (done, done + len(batch)))
+		done += len(batch)
+		if page is None:
+			failed.extend(batch)
+			continue
 
 		# parse the result
 		page_data = _parse_page(page)
@@ -344,29 +648,47 @@ def get_taxid(uid_list):
 			if taxid is not None:
 				out_data[key] = taxid
 
-		# do lookup of any missing identifiers from UniParc
-		if None in page_data.values():
+		# collect the obsolete/redundant identifiers, they are looked up in UniParc afterwards
+		obsolete.extend(key for key in page_data.keys() if page_data[key] is None)
 
-			# collect the offending identifiers
-			id_list = []
-			for key in page_data.keys():
-				if page_data[key] is None:
-					id_list.append(key)
+	# do lookup of the missing identifiers from UniParc
+	if obsolete:
+		temp_data, temp_failed = _get_taxid_from_uniparc(obsolete, scheduler)
+		out_data.update((key, value) for key, value in temp_data.items() if value is not None)
+		failed.extend(temp_failed)
 
-			# try to get the missing identifiers from UniParc
-			print('Retrieving %s obsolete/redundant taxids from UniParc ...' % len(id_list))
-			page = None
-			while page is None:
-				page = _retreive_info(id_list, from_db='ACC+ID', to_db='UPARC')
-				if page is None:
-					time.sleep(1)
-			print('Done')
+	if failed:
+		print('Could not retrieve %s UniprotIds from UniProt: %s' % (len(failed), ', '.join(failed[:10]) + (' ...' if len(failed) > 10 else '')))
 
-			# get the data out of the resulting page
-			temp_data = _parse_page(page)
+	return out_data, failed
 
-			# merge with output data
-			for key in temp_data.keys():
-				out_data[key] = temp_data[key].split('; ')[0] # sometimes there are many entries from the same org
 
-	return out_data
+def _get_taxid_from_uniparc(uid_list, scheduler=None):
+	'''
+	Given a list of obsolete or redundant uids, looks up the taxonomic identifier for the organisms from which they originate in UniParc.
+	The identifiers are sent in batches, several batches are downloaded at the same time.
+	Returns a dictionary with UniprotId keys and taxid values (None if UniParc did not have it),
+	and a list of the identifiers that could not be retrieved.
+	'''
+	if scheduler is None:
+		scheduler = uniprot_api.Scheduler(group_size=250)
+
+	out_data = {}
+	failed = []
+
+	print('Retrieving %s obsolete/redundant taxids from UniParc ...' % len(uid_list))
+	function = functools.partial(_retreive_info, from_db='ACC+ID', to_db='UPARC')
+	for batch, page in scheduler.run(function, uid_list):
+		if page is None:
+			failed.extend(batch)
+			continue
+
+		page_data = _parse_page(page)
+		for key in batch:
+			taxid = page_data.get(key)
+
+			# sometimes there are many entries from the same org
+			out_data[key] = None if taxid is None else taxid.split('; ')[0]
+	print('Done')
+
+	return out_data, failed
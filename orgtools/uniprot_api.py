@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+A shared client for the UniProt web services, used by the uid_tax and uid_pfam modules.
+Requests go through a single pooled session and batches are downloaded concurrently,
+with rate limiting, adaptive batch sizes and bounded retries.
+
+Copyright (C) 2017-2021  Martin Engqvist Lab
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+
+
+# The address of the uploadlists service, can be pointed elsewhere (for example to a local test server)
+UPLOADLISTS_URL = 'http://www.uniprot.org/uploadlists/'
+
+# The number of batches that are downloaded at the same time
+MAX_WORKERS = 4
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def session():
+	'''
+	Get the requests session that is shared by all UniProt lookups.
+	The connection pool is sized for the number of concurrent downloads so that connections are reused.
+	'''
+	global _SESSION
+	with _SESSION_LOCK:
+		if _SESSION is None:
+			_SESSION = requests.Session()
+			adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+			_SESSION.mount('http://', adapter)
+			_SESSION.mount('https://', adapter)
+
+	return _SESSION
+
+
+def query(params, url=None):
+	'''
+	Send a GET request to UniProt.
+	Returns the text of the response (empty if nothing was found), or None if the request failed.
+	'''
+	if url is None:
+		url = UPLOADLISTS_URL
+
+	try:
+		response = session().get(url, params=params)
+	except requests.RequestException as e:
+		print('Error when connecting to UniProt at "%s"' % url)
+		print('Error msg: ', e)
+		return None
+
+	if response.ok:
+		return response.text
+	else:
+		print('Unknown error when querying UniProt at "%s"' % url)
+		print('Error msg: ', response)
+		return None
+
+
+# Requests per second that are sent to UniProt, over all threads
+MAX_REQUESTS_PER_SECOND = 10
+
+# Batches are kept small enough for the identifiers to fit in a URL of this length
+MAX_URL_LENGTH = 7000
+
+# Batches grow while requests are answered faster than this (in seconds) and shrink when they are slower
+TARGET_LATENCY = 10.0
+
+# The number of times a single batch is tried again, and the number of retries shared by all batches of a lookup
+MAX_RETRIES = 5
+RETRY_BUDGET = 100
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+	'''
+	The time to wait before retry number attempt (counting from 0), growing exponentially with random jitter.
+	'''
+	return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket(object):
+	'''
+	Rate limiting shared by several threads, allows rate requests per second with bursts of up to capacity requests.
+	'''
+	def __init__(self, rate, capacity=None):
+		self.rate = rate
+		self.capacity = max(rate, 1) if capacity is None else capacity
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+
+	def acquire(self):
+		'''
+		Take a token, waiting until one is available.
+		'''
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+class Scheduler(object):
+	'''
+	Sends identifiers to UniProt in batches from several threads.
+	The batch size follows the observed latency (it grows while requests are fast and is halved when they are slow or fail)
+	and is limited by the URL length. Requests are rate limited with a token bucket,
+	and failed requests are tried again after an exponential backoff with jitter, within a retry budget.
+	Batches that still fail are reported instead of being tried forever.
+	'''
+	def __init__(self, group_size=100, min_size=10, max_size=1000, max_workers=None, rate=None, max_retries=None, retry_budget=None, target_latency=None, max_url_length=None):
+		self.group_size = group_size
+		self.min_size = min_size
+		self.max_size = max_size
+		self.max_workers = MAX_WORKERS if max_workers is None else max_workers
+		self.bucket = TokenBucket(MAX_REQUESTS_PER_SECOND if rate is None else rate)
+		self.max_retries = MAX_RETRIES if max_retries is None else max_retries
+		self.retry_budget = RETRY_BUDGET if retry_budget is None else retry_budget
+		self.target_latency = TARGET_LATENCY if target_latency is None else target_latency
+		self.max_url_length = MAX_URL_LENGTH if max_url_length is None else max_url_length
+		self.failed = []
+		self.lock = threading.Lock()
+
+
+	def _adapt(self, latency):
+		'''
+		Grow the batch size after a fast request, halve it after a slow or failed one (latency None).
+		'''
+		with self.lock:
+			if latency is not None and latency < self.target_latency:
+				self.group_size = min(self.max_size, max(self.group_size + 1, int(self.group_size * 1.25)))
+			else:
+				self.group_size = max(self.min_size, self.group_size // 2)
+
+
+	def _next_batch(self, id_list, start):
+		'''
+		Take the next batch from the list, as large as the current batch size and the URL length allow.
+		'''
+		length = 0
+		stop = start
+		while stop < len(id_list) and stop - start < self.group_size:
+			# each identifier is followed by an encoded space
+			length += len(id_list[stop]) + 3
+			if length > self.max_url_length and stop > start:
+				break
+			stop += 1
+
+		return id_list[start:stop]
+
+
+	def call(self, function, batch):
+		'''
+		Apply a function that queries UniProt to a batch, trying again with backoff if it returns None.
+		Returns the result, or None if the batch failed within the retries.
+		'''
+		for attempt in range(self.max_retries + 1):
+			self.bucket.acquire()
+			start_time = time.monotonic()
+			result = function(batch)
+			if result is not None:
+				self._adapt(time.monotonic() - start_time)
+				return result
+
+			self._adapt(None)
+			with self.lock:
+				if attempt == self.max_retries or self.retry_budget <= 0:
+					break
+				self.retry_budget -= 1
+			time.sleep(backoff(attempt))
+
+		with self.lock:
+			self.failed.append(batch)
+		print('Failed to retrieve a batch of %s identifiers from UniProt' % len(batch))
+		return None
+
+
+	def run(self, function, id_list):
+		'''
+		Apply a function that queries UniProt to the identifiers in batches, in worker threads.
+		Duplicate identifiers are only sent once.
+		Yields each batch with its result, or with None if it failed, in the order of the identifiers.
+		'''
+		id_list = list(dict.fromkeys(id_list))
+		with ThreadPoolExecutor(self.max_workers) as executor:
+			pending = deque()
+			start = 0
+			while start < len(id_list):
+				batch = self._next_batch(id_list, start)
+				start += len(batch)
+				pending.append((batch, executor.submit(self.call, function, batch)))
+				if len(pending) >= self.max_workers:
+					batch, future = pending.popleft()
+					yield batch, future.result()
+
+			while pending:
+				batch, future = pending.popleft()
+				yield batch, future.result()
+
+
+# marks identifiers that fetch did not return a result for
+_MISSING = object()
+
+
+class SingleFlight(object):
+	'''
+	Lets threads that look up overlapping identifiers at the same time share the requests.
+	An identifier that is already being fetched by one thread is not fetched again by another,
+	which instead waits for the first one to finish and gets the same result.
+	'''
+	def __init__(self):
+		self.in_flight = {}
+		self.lock = threading.Lock()
+
+
+	def resolve(self, id_list, fetch):
+		'''
+		Get the results for a list of identifiers, where fetch is a function that takes a list of identifiers
+		and returns a dictionary with the results for them (identifiers without a result may be left out).
+		Only the identifiers that no other thread is fetching are passed to fetch, and each of them only once.
+		Returns a dictionary with the results for all the identifiers.
+		'''
+		own = {}
+		shared = {}
+		with self.lock:
+			for identifier in dict.fromkeys(id_list):
+				if identifier in self.in_flight:
+					shared[identifier] = self.in_flight[identifier]
+				else:
+					own[identifier] = self.in_flight[identifier] = Future()
+
+		# fetch the identifiers that this thread is responsible for, and hand the results to the waiting threads
+		if own:
+			try:
+				result = fetch(list(own.keys()))
+			except BaseException as e:
+				for future in own.values():
+					future.set_exception(e)
+				raise
+			else:
+				for identifier, future in own.items():
+					future.set_result(result.get(identifier, _MISSING))
+			finally:
+				with self.lock:
+					for identifier in own:
+						del self.in_flight[identifier]
+
+		out_data = {}
+		for identifier, future in itertools.chain(own.items(), shared.items()):
+			value = future.result()
+			if value is not _MISSING:
+				out_data[identifier] = value
+
+		return out_data
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+A persistent local cache for results obtained from UniProt, used by the uid_tax and uid_pfam modules.
+Entries expire after a set time and the least recently used entries are evicted when the cache grows too large.
+The cache is an SQLite database, so it can safely be shared by several processes.
+
+Copyright (C) 2017-2021  Martin Engqvist Lab
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from os.path import exists, dirname
+from pkg_resources import resource_filename
+
+
+CACHE_FILE = 'data/cache/uniprot_cache.db'
+
+# Entries older than this many seconds are fetched again
+CACHE_TTL = 30 * 24 * 60 * 60
+
+# When the cache holds more entries than this the least recently used ones are removed
+CACHE_MAX_ENTRIES = 5000000
+
+# Expired and surplus entries are removed on the first write of a process and then after every this many written entries
+EVICT_INTERVAL = 100000
+
+# The number of entries written to each cache file since it was last cleaned up in this process
+_WRITES = {}
+
+
+class Cache(object):
+	'''
+	A key-value cache on disk, where each namespace (for example "taxid" or "pfam") holds its own keys.
+	Values are stored as JSON.
+	'''
+	def __init__(self, namespace, filepath=None, ttl=None, max_entries=None):
+		if filepath is None:
+			filepath = resource_filename(__name__, CACHE_FILE)
+		self.filepath = filepath
+		self.namespace = namespace
+		self.ttl = CACHE_TTL if ttl is None else ttl
+		self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+
+		if not exists(dirname(self.filepath)):
+			os.makedirs(dirname(self.filepath), exist_ok=True)
+
+		con = self._connect()
+		with con:
+			con.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, expires REAL, accessed REAL, PRIMARY KEY (namespace, key))')
+			con.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+			con.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+		con.close()
+
+
+	def _connect(self):
+		'''
+		Open a connection to the cache, waiting for other processes that are writing to it.
+		'''
+		con = sqlite3.connect(self.filepath, timeout=60)
+		con.execute('PRAGMA journal_mode=WAL')
+		return con
+
+
+	def get_many(self, keys):
+		'''
+		Look up many keys at once.
+		Returns a dictionary with the keys that were found and have not expired.
+		'''
+		keys = list(set(keys))
+		now = time.time()
+		out_data = {}
+
+		con = self._connect()
+		with con:
+			for n in range(0, len(keys), 500):
+				chunk = keys[n:n+500]
+				query = 'SELECT key, value FROM cache WHERE namespace = ? AND expires > ? AND key IN (%s)' % ','.join('?' * len(chunk))
+				for key, value in con.execute(query, [self.namespace, now] + chunk):
+					out_data[key] = json.loads(value)
+
+			# mark the entries as used so that they are evicted last
+			con.executemany('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?', ((now, self.namespace, key) for key in out_data))
+		con.close()
+
+		return out_data
+
+
+	def set_many(self, data):
+		'''
+		Store the keys and values of a dictionary.
+		'''
+		now = time.time()
+		rows = ((self.namespace, key, json.dumps(value), now + self.ttl, now) for key, value in data.items())
+
+		con = self._connect()
+		with con:
+			con.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)', rows)
+
+		# counting the entries takes a pass over the table, so this is only done now and then
+		writes = _WRITES.get(self.filepath)
+		if writes is None or writes + len(data) >= EVICT_INTERVAL:
+			self._evict(con, now)
+			_WRITES[self.filepath] = 0
+		else:
+			_WRITES[self.filepath] = writes + len(data)
+		con.close()
+
+
+	def _evict(self, con, now):
+		'''
+		Remove expired entries, and the least recently used entries if the cache is larger than allowed.
+		'''
+		with con:
+			con.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+
+			size = con.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+			if size > self.max_entries:
+				con.execute('DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed LIMIT ?)', (size - self.max_entries,))
+
+
+	def clear(self):
+		'''
+		Remove all entries in this namespace.
+		'''
+		con = self._connect()
+		with con:
+			con.execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+		con.close()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Tests of the UniProt client against a local server that injects faults.
+The server answers the uploadlists queries with made-up taxids (the length of each identifier),
+and fails the requests that the test asks it to fail with "503 Service Unavailable".
+Identifiers starting with "OBS" are obsolete, UniProtKB gives no taxid for them but UniParc does ("562; 563"),
+and identifiers starting with "DEAD" are not known anywhere.
+
+Copyright (C) 2017-2021  Martin Engqvist Lab
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+import unittest
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from orgtools import uniprot_api, uid_tax
+
+
+class FaultyHandler(BaseHTTPRequestHandler):
+	'''
+	Answers uploadlists queries, failing a request whenever the fail function of the server returns True for it.
+	The identifiers of the requests that were answered are recorded in the answered list of the server,
+	and requests are held back while the release event of the server is not set.
+	'''
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+
+	def do_GET(self):
+		server = self.server
+		params = parse_qs(urlparse(self.path).query)
+		uid_list = params.get('query', [''])[0].split()
+		to_db = params.get('to', ['ACC'])[0]
+
+		with server.lock:
+			server.requests += 1
+			request = server.requests
+		server.started.set()
+		server.release.wait()
+
+		if server.fail(request):
+			self.send_response(503)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		with server.lock:
+			server.answered.append((to_db, uid_list))
+
+		lines = ['Organism ID\tyourlist']
+		for uid in uid_list:
+			if uid.startswith('DEAD'):
+				continue
+			elif to_db == 'UPARC':
+				lines.append('562; 563\t%s' % uid)
+			elif uid.startswith('OBS'):
+				lines.append('\t%s' % uid)
+			else:
+				lines.append('%s\t%s' % (len(uid), uid))
+		body = ('\n'.join(lines) + '\n').encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class SchedulerTest(unittest.TestCase):
+	'''
+	Runs the Scheduler and get_taxid() against the fault-injecting server.
+	'''
+	def setUp(self):
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), FaultyHandler)
+		self.server.lock = threading.Lock()
+		self.server.requests = 0
+		self.server.fail = lambda request: False
+		self.server.answered = []
+		self.server.started = threading.Event()
+		self.server.release = threading.Event()
+		self.server.release.set()
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		# point the client to the server, and do not wait between retries
+		patches = [mock.patch.object(uniprot_api, 'UPLOADLISTS_URL', 'http://127.0.0.1:%s/uploadlists/' % self.server.server_address[1]),
+					mock.patch.object(uniprot_api, 'backoff', lambda attempt: 0)]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+
+	def tearDown(self):
+		self.server.release.set()
+		self.server.shutdown()
+		self.server.server_close()
+
+
+	def _query(self, batch):
+		return uniprot_api.query({'query':' '.join(batch)})
+
+
+	def test_all_batches_succeed(self):
+		uid_list = ['P%05d' % n for n in range(95)]
+		scheduler = uniprot_api.Scheduler(group_size=10, min_size=10, rate=1000)
+		pages = list(scheduler.run(self._query, uid_list + uid_list[:5]))
+
+		self.assertEqual([uid for batch, page in pages for uid in batch], uid_list)
+		self.assertTrue(all(page is not None for batch, page in pages))
+		self.assertEqual(scheduler.failed, [])
+
+
+	def test_failures_are_retried(self):
+		# every other request fails
+		self.server.fail = lambda request: request % 2 == 1
+		uid_list = ['P%05d' % n for n in range(50)]
+		scheduler = uniprot_api.Scheduler(group_size=10, min_size=10, rate=1000, max_workers=1)
+		pages = list(scheduler.run(self._query, uid_list))
+
+		self.assertTrue(all(page is not None for batch, page in pages))
+		self.assertEqual(scheduler.failed, [])
+		self.assertEqual(self.server.requests, 2 * len(pages))
+
+
+	def test_retries_per_batch_are_bounded(self):
+		self.server.fail = lambda request: True
+		uid_list = ['P%05d' % n for n in range(30)]
+		scheduler = uniprot_api.Scheduler(group_size=10, min_size=10, rate=1000, max_retries=2, retry_budget=100)
+		pages = list(scheduler.run(self._query, uid_list))
+
+		self.assertEqual(len(pages), 3)
+		self.assertTrue(all(page is None for batch, page in pages))
+		self.assertEqual(sorted(uid for batch in scheduler.failed for uid in batch), uid_list)
+		self.assertEqual(self.server.requests, 3 * (2 + 1))
+
+
+	def test_retry_budget_is_shared(self):
+		self.server.fail = lambda request: True
+		uid_list = ['P%05d' % n for n in range(50)]
+		scheduler = uniprot_api.Scheduler(group_size=10, min_size=10, rate=1000, max_retries=10, retry_budget=4)
+		pages = list(scheduler.run(self._query, uid_list))
+
+		self.assertEqual(len(pages), 5)
+		self.assertEqual(len(scheduler.failed), 5)
+		self.assertEqual(self.server.requests, 5 + 4)
+
+
+	def test_failed_identifiers_are_left_out(self):
+		# the first batch fails for good, the rest succeed
+		self.server.fail = lambda request: request <= uniprot_api.MAX_RETRIES + 1
+		uid_list = ['P%05d' % n for n in range(500)]
+		with mock.patch.object(uniprot_api, 'MAX_WORKERS', 1):
+			out_data, failed = uid_tax._get_taxid_from_uniprot(uid_list)
+
+		self.assertTrue(len(failed) > 0)
+		self.assertEqual(sorted(list(out_data.keys()) + failed), uid_list)
+		self.assertTrue(all(value == '6' for value in out_data.values()))
+
+
+	def test_obsolete_identifiers_are_looked_up_in_uniparc(self):
+		uid_list = ['P%05d' % n for n in range(20)] + ['OBS%03d' % n for n in range(10)] + ['DEAD01']
+		out_data, failed = uid_tax._get_taxid_from_uniprot(uid_list)
+
+		self.assertEqual(failed, [])
+		self.assertEqual(out_data, dict([('P%05d' % n, '6') for n in range(20)] + [('OBS%03d' % n, '562') for n in range(10)]))
+
+		# only the obsolete identifiers are sent to UniParc
+		uparc = [uid for to_db, batch in self.server.answered if to_db == 'UPARC' for uid in batch]
+		self.assertEqual(sorted(uparc), ['OBS%03d' % n for n in range(10)])
+
+
+	def test_uniparc_misses_are_none(self):
+		out_data, failed = uid_tax._get_taxid_from_uniparc(['OBS001', 'DEAD01'])
+
+		self.assertEqual(failed, [])
+		self.assertEqual(out_data, {'OBS001':'562', 'DEAD01':None})
+
+
+	def test_failed_uniparc_identifiers_are_left_out(self):
+		# the UniProtKB batch succeeds, the UniParc batch after it fails for good
+		self.server.fail = lambda request: request > 1
+		uid_list = ['P%05d' % n for n in range(20)] + ['OBS%03d' % n for n in range(10)]
+		with mock.patch.object(uniprot_api, 'MAX_WORKERS', 1):
+			out_data, failed = uid_tax._get_taxid_from_uniprot(uid_list)
+
+		self.assertEqual(sorted(failed), ['OBS%03d' % n for n in range(10)])
+		self.assertEqual(out_data, {'P%05d' % n:'6' for n in range(20)})
+
+
+	def _lookup_concurrently(self, id_sets):
+		'''
+		Look up each list of identifiers with get_taxid() in its own thread, while the server holds the requests back.
+		A thread is only started once the previous one has claimed its identifiers (and the first one has sent its request),
+		so the first thread is the one that fetches the shared identifiers.
+		Returns the result, or the exception, of each thread.
+		'''
+		flights = uniprot_api.SingleFlight()
+		results = [None] * len(id_sets)
+
+		def lookup(n):
+			try:
+				results[n] = uid_tax.get_taxid(id_sets[n], use_cache=False)
+			except Exception as e:
+				results[n] = e
+
+		def claimed(id_list):
+			with flights.lock:
+				return all(uid in flights.in_flight for uid in id_list)
+
+		self.server.release.clear()
+		threads = []
+		with mock.patch.object(uid_tax, '_FLIGHTS', flights):
+			for n in range(len(id_sets)):
+				threads.append(threading.Thread(target=lookup, args=(n,)))
+				threads[-1].start()
+				self._wait_for(lambda: claimed(id_sets[n]))
+				if n == 0:
+					self._wait_for(self.server.started.is_set)
+
+			self.server.release.set()
+			for thread in threads:
+				thread.join(30)
+
+		self.assertFalse(any(thread.is_alive() for thread in threads))
+		self.assertEqual(flights.in_flight, {})
+		return results
+
+
+	def _wait_for(self, condition):
+		deadline = time.monotonic() + 10
+		while not condition():
+			self.assertLess(time.monotonic(), deadline)
+			time.sleep(0.001)
+
+
+	def _requested(self):
+		'''
+		Count how many times each identifier was answered by the server.
+		'''
+		return Counter(uid for to_db, batch in self.server.answered for uid in batch)
+
+
+	def test_concurrent_lookups_share_requests(self):
+		id_sets = [['P%05d' % n for n in range(start, start + 20)] for start in (0, 10, 15)]
+		results = self._lookup_concurrently(id_sets)
+
+		for id_set, result in zip(id_sets, results):
+			self.assertEqual(result, {uid:'6' for uid in id_set})
+		self.assertEqual(self._requested(), Counter('P%05d' % n for n in range(35)))
+
+
+	def test_concurrent_lookups_survive_a_failed_request(self):
+		# the request of the first thread fails once, the retry is shared with the others
+		self.server.fail = lambda request: request == 1
+		id_sets = [['P%05d' % n for n in range(start, start + 20)] for start in (0, 10, 15)]
+		results = self._lookup_concurrently(id_sets)
+
+		for id_set, result in zip(id_sets, results):
+			self.assertEqual(result, {uid:'6' for uid in id_set})
+		self.assertEqual(self._requested(), Counter('P%05d' % n for n in range(35)))
+		self.assertEqual(self.server.requests, len(self.server.answered) + 1)
+
+
+	def test_concurrent_lookups_share_errors(self):
+		# the page of the first thread cannot be parsed, the threads that wait for its identifiers get the same error
+		parse_page = uid_tax._parse_page
+		def broken_parse_page(page):
+			if 'P00000' in page:
+				raise ValueError('malformed page')
+			return parse_page(page)
+
+		id_sets = [['P%05d' % n for n in range(start, start + 20)] for start in (0, 10, 15)]
+		with mock.patch.object(uid_tax, '_parse_page', broken_parse_page):
+			results = self._lookup_concurrently(id_sets)
+
+		self.assertTrue(all(isinstance(result, ValueError) for result in results))
+		self.assertEqual(self._requested(), Counter('P%05d' % n for n in range(35)))
+
+		# nothing is left in flight, the identifiers can be looked up again
+		self.assertEqual(uid_tax.get_taxid(id_sets[0], use_cache=False), {uid:'6' for uid in id_sets[0]})
+
+
+
+if __name__ == '__main__':
+	unittest.main()